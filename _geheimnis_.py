@@ -68,6 +68,7 @@ class _database:
     _hasher = hash_generator()
 
     def __init__(self, uri, access_key):
+        self._uri = uri
         cryptor = xipher(access_key)
 
         create_db = True
@@ -142,6 +143,24 @@ class _database:
         table = {}
         return self
 
+    def sync(self):
+        """Write all changes to the database file now."""
+        self._database.sync()
+        return self
+
+    def reload(self):
+        """Open the database file again, forgetting all tables read so far
+        without writing them back. Changes made by other processes since
+        become visible; unsaved changes of this one are lost.
+
+        The whole table tree is written back when the database is closed,
+        so a long running process should call this before its lengthy
+        work, and again before making changes."""
+        self._database.cache.clear()
+        self._database.close()
+        self._database = shelve.open(self._uri, writeback=True, flag='rw')
+        return self
+
     def _touch_path(self, table_path):
         tree = table_path.split('/')
         for each in tree:
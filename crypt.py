@@ -28,30 +28,46 @@ import zlib
 import msgpack
 
 from hash import hash_generator
-from cryptoalgo.symmetric import serpent, rijndael, xxtea
+from cryptoalgo import symmetric
 
 class dummycipher_sha256:
+    """HMAC-SHA256 used as a pseudo random function in the cipher chain.
+
+    The inner and outer HMAC contexts are compressed once per key, each
+    block then only copies them."""
 
     key_size = 32
+    block_size = 64
+
+    _trans_5C = ''.join([chr(x ^ 0x5C) for x in xrange(256)])
+    _trans_36 = ''.join([chr(x ^ 0x36) for x in xrange(256)])
 
     def __init__(self, key):
-        self.hmac = hash_generator().option({
-            'algorithm': 'SHA-256',
-            'HMAC': key,
-            'output_format': 'RAW',
-        })
+        if len(key) > self.block_size:
+            key = hashlib.sha256(key).digest()
+        key += chr(0) * (self.block_size - len(key))
+        self._inner = hashlib.sha256(key.translate(self._trans_36))
+        self._outer = hashlib.sha256(key.translate(self._trans_5C))
 
     def encrypt(self, data):
-        return self.hmac.digest(data)
+        inner = self._inner.copy()
+        inner.update(data)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def encrypt_many(self, data, size):
+        """Encrypt every 'size' bytes of data as a block of its own."""
+        return ''.join([
+            self.encrypt(data[i:i+size]) for i in xrange(0, len(data), size)
+        ])
 
 class xipher:
 
-    cipherlist = [
-        [serpent.Serpent, serpent.key_size],
-        [rijndael.get_class(), rijndael.key_size],
-        [dummycipher_sha256, dummycipher_sha256.key_size],
-        [xxtea.XXTEA, xxtea.key_size],
-    ]
+    # The chain, by cipher names registered in cryptoalgo.symmetric. These
+    # are resolved into 'cipherlist' when the first xipher is made.
+    ciphers = ['serpent', 'rijndael', dummycipher_sha256, 'xxtea']
+    cipherlist = None
     blocksize = 32 
     ivsize = 16
 
@@ -63,13 +79,16 @@ class xipher:
 
     def __init__(self, key):
         """Initialize this class using a 'key'."""
+        # Key derivation works on HEX digests. This used to be implied by
+        # the MD5 hasher below overriding the output format shared by all
+        # hash generators; existing data depends on it.
         self._whirlpool_hasher = hash_generator().option({
-            'output_format': 'raw',
+            'output_format': 'HEX',
             'algorithm': 'WHIRLPOOL',
             'HMAC': False,
         })
         self._sha512_hasher = hash_generator().option({
-            'output_format': 'raw',
+            'output_format': 'HEX',
             'algorithm': 'SHA-512',
             'HMAC': False,
         })
@@ -79,6 +98,9 @@ class xipher:
             'HMAC': False,
         })
 
+        if xipher.cipherlist == None:
+            xipher.cipherlist = self._load_cipherlist()
+
         shifting_list = self.cipherlist[:]
         self.encrypt_chain = []
         derivedkey = self._derive_key(key[:])
@@ -87,7 +109,7 @@ class xipher:
         for i in xrange(len(self.cipherlist)):
             keyring = derivedkey[:]
             for x in shifting_list:
-                self.encrypt_chain.append((x[0],keyring[0:x[1]]))
+                self.encrypt_chain.append(x[0](keyring[0:x[1]]))
                 keyring = keyring[x[1]:]
             derivedkey = self._derive_key(derivedkey)
 
@@ -97,6 +119,18 @@ class xipher:
         derivedkey = None
         del derivedkey
 
+    def _load_cipherlist(self):
+        cipherlist = []
+        for cipher in self.ciphers:
+            if type(cipher) == str:
+                cipherlist.append([
+                    symmetric.get_class(cipher),
+                    symmetric.get_info(cipher)['key_size'],
+                ])
+            else:
+                cipherlist.append([cipher, cipher.key_size])
+        return cipherlist
+
     def _derive_key(self, oldkey):
         key_whirlpool = self._whirlpool_hasher.digest(oldkey)
         key_sha512 = self._sha512_hasher.digest(oldkey)
@@ -106,10 +140,19 @@ class xipher:
         return ''.join(ret)
 
     def _encrypt_block(self,data):
-        length = len(self.encrypt_chain)
-        for i in xrange(length):
-            tool = self.encrypt_chain[i]
-            data = tool[0](tool[1]).encrypt(data)
+        return self._encrypt_blocks(data)
+
+    def _encrypt_blocks(self, data):
+        """Encrypt consecutive, independent blocks through the chain.
+
+        All blocks pass one cipher before going on to the next. Ciphers
+        offering encrypt_many() get the block size, the others work in
+        ECB mode over their own (smaller) block size anyway."""
+        for tool in self.encrypt_chain:
+            if hasattr(tool, 'encrypt_many'):
+                data = tool.encrypt_many(data, self.blocksize)
+            else:
+                data = tool.encrypt(data)
         return data
 
     def _xor_stream(self,stream,data):
@@ -127,11 +170,10 @@ class xipher:
         
         'times' is how much the counter repeats.
         'iv' is initial vector."""
-        ret = ''
-        blocks = ['aaaabbbbccccddddeeeeffffgggghhhh'] * (bis - von)
-        for i in xrange(von, bis):
-            blocks[i-von] = self._encrypt_block("%16s%16s" % (iv,hex(i)[2:]))
-        blocks = ''.join(blocks)
+        blocks = ''.join([
+            "%16s%16s" % (iv,hex(i)[2:]) for i in xrange(von, bis)
+        ])
+        blocks = self._encrypt_blocks(blocks)
 
         ciblk = [ord(i) for i in blocks]
         return ciblk
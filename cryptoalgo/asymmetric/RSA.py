@@ -6,11 +6,94 @@ A textbook-style RSA implementation
 This RSA implementation is mostly a wrapper of library pyCrypto, but modifying
 interfaces so as all public key algorithms can use the same operational
 sequence.
-The implementation is as nature as possible. 
+The implementation is as nature as possible.
+
+Encryption uses RSAES-OAEP, signatures use RSASSA-PSS with SHA-256. Private
+keys always carry p, q and u, so pyCrypto does its private key operations
+with the Chinese Remainder Theorem.
+
+Keys are exported as Msgpack-ed lists of big-endian byte strings:
+
+    ['RSA', n, e]                   public key
+    ['RSA', n, e, d, p, q, u]       private key
+
+and loaded again with Implementation(load=...). The fingerprint of a key is
+the SHA-1 of its public export, in HEX. Parsed keys are kept in a bounded
+cache, so loading the same key again is cheap. Private keys are cached by
+their full export and checked for consistency when first loaded.
+
+sign_many() and verify_many() handle batches of messages under any number of
+keys. Large batches are spread over a multiprocessing pool.
+
+Generating a key of 2048 bits or more is slow. set_key_pool() registers a
+pool of keys generated in advance (see keypool_manager in pki.py), which
+generate() then takes its key from when it has one of the wanted size.
 """
 
+import collections
+import hashlib
+
+import msgpack
+from Crypto import Random
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_PSS
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+
+KEY_CACHE_SIZE = 64
+
+# Batches smaller than this are done in the calling process. Larger ones are
+# cut into chunks of PARALLEL_CHUNK messages under the same key, which are
+# handed out to a process pool.
+PARALLEL_MIN_ITEMS = 64
+PARALLEL_CHUNK = 16
+
+# Cache ID -> [key object, cipher, signer]. A public key is cached by its
+# fingerprint alone, a private key also by the SHA-1 of its full export, so
+# that an export with forged private fields never matches a cached key.
+_key_cache = collections.OrderedDict()
+
+# Object with take(bits), returning a new Implementation or None, which is
+# asked for a key by Implementation.generate() first.
+_key_pool = None
+
+def set_key_pool(pool):
+    """Register the key pool used by Implementation.generate(), or remove it
+    with None."""
+    global _key_pool
+    _key_pool = pool
 
+def _cache_id(numbers):
+    """Return (fingerprint, private key ID or None) of the key given by the
+    tuple (n, e) or (n, e, d, p, q, u). Both are computed from the canonical
+    export of the numbers, whatever encoding they were loaded from."""
+    fields = ['RSA'] + [long_to_bytes(i) for i in numbers]
+    fingerprint = hashlib.sha1(msgpack.packb(fields[:3])).hexdigest()
+    if len(fields) == 3:
+        return (fingerprint, None)
+    return (fingerprint, hashlib.sha1(msgpack.packb(fields)).hexdigest())
+
+def _cache_get(cache_id):
+    entry = _key_cache.pop(cache_id, None)
+    if entry is not None:
+        _key_cache[cache_id] = entry
+    return entry
+
+def _cache_put(cache_id, entry):
+    _key_cache.pop(cache_id, None)
+    _key_cache[cache_id] = entry
+    while len(_key_cache) > KEY_CACHE_SIZE:
+        _key_cache.popitem(last=False)
+
+def _is_consistent(n, e, d, p, q, u):
+    """Check the private fields of a key against each other and n. pyCrypto
+    trusts them and may even crash on nonsense values."""
+    if p < 2 or q < 2 or p * q != n:
+        return False
+    if u * p % q != 1:
+        return False
+    return d * e % (p - 1) == 1 % (p - 1) and d * e % (q - 1) == 1 % (q - 1)
 
 class Implementation:
 
@@ -18,7 +101,10 @@ class Implementation:
     _self_signature = None
 
     def __init__(self, load=''):
-        pass
+        self._entry = None
+        self._fingerprint = None
+        if load:
+            self._load(load)
 
     def has_private_key(self):
         self._check_initialized()
@@ -33,52 +119,260 @@ class Implementation:
         return self._obj.can_sign()
 
     def generate(self, **param):
+        """Generate a new key of param 'bits' bits. The key is taken from the
+        registered key pool if there is one of this size, unless param
+        'pooled' is False."""
         bits = int(param['bits'])
         if bits % 256 != 0 or bits / 256 < 4:
             raise Exception(
                 'RSA generate - invalid bits(%s) specified.' % bits
             )
 
-        self._obj = RSA.generate(bits)
+        if param.get('pooled', True) and _key_pool != None:
+            key = _key_pool.take(bits)
+            if key != None:
+                self._set_key(key._obj)
+                return
+        self._set_key(RSA.generate(bits))
 
-    def encrypt(self):
+    def encrypt(self, plaintext):
         self._check_initialized()
-         
+        return self._get_entry()[1].encrypt(plaintext)
 
-    def decrypt(self):
+    def decrypt(self, ciphertext):
         self._check_initialized()
-        pass
+        if not self._obj.has_private():
+            raise Exception('RSA decrypt - no private key.')
+        return self._get_entry()[1].decrypt(ciphertext)
 
     def sign(self, plaintext):
         self._check_initialized()
-        pass
+        if not self._obj.has_private():
+            raise Exception('RSA sign - no private key.')
+        return self._get_entry()[2].sign(SHA256.new(plaintext))
 
-    def verify(self, plaintext):
+    def verify(self, plaintext, signature):
         self._check_initialized()
-        pass
+        try:
+            return bool(
+                self._get_entry()[2].verify(SHA256.new(plaintext), signature)
+            )
+        except ValueError:
+            # Raised by pyCrypto for a signature not smaller than n.
+            return False
 
     def get_private_key(self):
         self._check_initialized()
-        pass
+        if not self._obj.has_private():
+            raise Exception('RSA export - no private key.')
+        return self._export(['n', 'e', 'd', 'p', 'q', 'u'])
 
     def get_public_key(self):
         self._check_initialized()
-        pass
+        return self._export(['n', 'e'])
 
     def get_fingerprint(self):
         self._check_initialized()
-        pass
+        if self._fingerprint is None:
+            self._fingerprint = \
+                hashlib.sha1(self.get_public_key()).hexdigest()
+        return self._fingerprint
+
+    def _export(self, fields):
+        return msgpack.packb(
+            ['RSA'] + [long_to_bytes(getattr(self._obj, i)) for i in fields]
+        )
+
+    def _load(self, exported):
+        try:
+            fields = msgpack.unpackb(exported)
+            if fields[0] != 'RSA' or len(fields) not in (3, 7):
+                raise ValueError()
+            for field in fields[1:]:
+                if type(field) != str:
+                    raise ValueError()
+            numbers = tuple(bytes_to_long(i) for i in fields[1:])
+        except Exception:
+            raise Exception('RSA load - invalid key data.')
+
+        # A key which has been parsed before is taken from the cache.
+        cache_id = _cache_id(numbers)
+        entry = _cache_get(cache_id)
+        if entry is None:
+            if len(numbers) == 6 and not _is_consistent(*numbers):
+                raise Exception('RSA load - invalid key data.')
+            obj = RSA.construct(numbers)
+            entry = self._new_entry(obj)
+            _cache_put(cache_id, entry)
+        self._obj = entry[0]
+        self._entry = entry
+        self._fingerprint = cache_id[0]
+
+    def _set_key(self, obj):
+        self._obj = obj
+        self._entry = None
+        self._fingerprint = None
+
+    def _new_entry(self, obj):
+        return [obj, PKCS1_OAEP.new(obj), PKCS1_PSS.new(obj)]
+
+    def _get_entry(self):
+        if self._entry is None:
+            names = ['n', 'e']
+            if self._obj.has_private():
+                names += ['d', 'p', 'q', 'u']
+            cache_id = _cache_id([getattr(self._obj, i) for i in names])
+            entry = _cache_get(cache_id)
+            if entry is None:
+                entry = self._new_entry(self._obj)
+                _cache_put(cache_id, entry)
+            self._entry = entry
+        return self._entry
 
     def _check_initialized(self):
-        if self._obj == None:
+        if self._obj is None:
             raise Exception('RSA instance not initialized.')
-        
+
+
+def _sign_task(task):
+    key, messages = task
+    signer = Implementation(load=key)
+    return [signer.sign(message) for (message,) in messages]
+
+def _verify_task(task):
+    key, pairs = task
+    try:
+        verifier = Implementation(load=key)
+    except Exception:
+        return [False] * len(pairs)
+    return [verifier.verify(message, signature)
+            for message, signature in pairs]
+
+def _run_batch(function, items, processes):
+    # Group the items by key, keeping input order within each key, so every
+    # key is parsed once per chunk at most (and once per process thanks to
+    # the key cache).
+    groups = collections.OrderedDict()
+    for index, item in enumerate(items):
+        groups.setdefault(item[0], []).append(index)
+
+    tasks, owners = [], []
+    for key, indexes in groups.iteritems():
+        for i in xrange(0, len(indexes), PARALLEL_CHUNK):
+            chunk = indexes[i:i + PARALLEL_CHUNK]
+            tasks.append((key, [tuple(items[j][1:]) for j in chunk]))
+            owners.append(chunk)
+
+    # Imported here: keys are loaded by every command using the PKI, only
+    # batches need a pool.
+    import multiprocessing
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    if len(items) < PARALLEL_MIN_ITEMS or processes < 2 or len(tasks) < 2:
+        outputs = map(function, tasks)
+    else:
+        # pyCrypto's RNG must be reseeded in each forked worker.
+        pool = multiprocessing.Pool(
+            min(processes, len(tasks)),
+            initializer=Random.atfork
+        )
+        try:
+            outputs = pool.map(function, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = [None] * len(items)
+    for chunk, output in zip(owners, outputs):
+        for index, result in zip(chunk, output):
+            results[index] = result
+    return results
+
+def sign_many(items, processes=None):
+    """Sign a batch of messages. 'items' is a list of (private key export,
+    message) pairs; returns the list of signatures in the same order.
+
+    'processes' limits the size of the process pool used for large batches,
+    by default all CPUs are used."""
+    return _run_batch(_sign_task, items, processes)
+
+def verify_many(items, processes=None):
+    """Verify a batch of signatures. 'items' is a list of (public or private
+    key export, message, signature); returns a list of True or False in the
+    same order. A key which cannot be loaded fails all its signatures."""
+    return _run_batch(_verify_task, items, processes)
+
 
 def self_test():
     # Generate RSA key-pair.
     new_key = Implementation()
     new_key.generate(bits=1024)
 
+    # Export and load again.
+    private_key = Implementation(load=new_key.get_private_key())
+    public_key = Implementation(load=new_key.get_public_key())
+    assert private_key.has_private_key()
+    assert not public_key.has_private_key()
+    assert private_key.get_fingerprint() == new_key.get_fingerprint()
+    assert public_key.get_fingerprint() == new_key.get_fingerprint()
+    assert Implementation(load=new_key.get_public_key())._obj \
+        is public_key._obj
+    assert Implementation(load=new_key.get_private_key())._obj \
+        is private_key._obj
+
+    # Forged private fields must not pick up the cached private key.
+    forged = msgpack.unpackb(new_key.get_public_key()) + \
+        ['\x01', '\x02', '\x03', '\x04']
+    try:
+        Implementation(load=msgpack.packb(forged))
+        assert False
+    except AssertionError:
+        raise
+    except Exception:
+        pass
+
+    # A non-canonical export (leading zero bytes) is the same key.
+    fields = msgpack.unpackb(new_key.get_private_key())
+    padded = Implementation(
+        load=msgpack.packb(['RSA'] + ['\x00' + i for i in fields[1:]])
+    )
+    assert padded.get_fingerprint() == new_key.get_fingerprint()
+    assert padded.get_private_key() == new_key.get_private_key()
+    assert padded._obj is private_key._obj
+
+    # Encryption and signatures.
+    message = 'The quick brown fox jumps over the lazy dog'
+    assert private_key.decrypt(public_key.encrypt(message)) == message
+    signature = new_key.sign(message)
+    assert public_key.verify(message, signature)
+    assert not public_key.verify(message + '.', signature)
+
+    # A registered key pool is used, except when asked not to.
+    class test_pool:
+        def take(self, bits):
+            if bits == 1024:
+                return new_key
+    set_key_pool(test_pool())
+    try:
+        pooled_key = Implementation()
+        pooled_key.generate(bits=1024)
+        assert pooled_key.get_fingerprint() == new_key.get_fingerprint()
+        other_key = Implementation()
+        other_key.generate(bits=1024, pooled=False)
+        assert other_key.get_fingerprint() != new_key.get_fingerprint()
+    finally:
+        set_key_pool(None)
+
+    # Batches, both in this process and in a pool.
+    keys = [new_key.get_private_key(), other_key.get_private_key()]
+    for count in (5, PARALLEL_MIN_ITEMS):
+        items = [(keys[i % 3 == 0], 'message %d' % i) for i in xrange(count)]
+        signatures = sign_many(items, processes=2)
+        checks = [(key, message, signature)
+                  for (key, message), signature in zip(items, signatures)]
+        checks.append((keys[0], 'forged', signatures[0]))
+        assert verify_many(checks, processes=2) == [True] * count + [False]
+
 
 if __name__ == '__main__':
     self_test()
@@ -21,12 +21,23 @@
 '''
     Pure Python Implementation of SHA1/SHA2
 
+    This is the fallback used by the cryptoalgo.hash modules when hashlib
+    is not available. Messages are processed a block at a time as tuples
+    of big-endian words (via struct), and the objects can be fed
+    incrementally just like those from hashlib.
+
     Create a hash by calling one of the named constructor functions:
         sha1(), sha224(), sha256(), sha384(), and sha512().
 
     The resulting hash objects have these methods:
 
-     - digest():       Return the digest of the message
+     - update(arg):    Feed more data into the hash object.
+
+     - copy():         Return an independent copy of the hash object,
+                       e.g. to hash several messages sharing a prefix.
+
+     - digest():       Return the digest of the message so far. The
+                       object can still be updated afterwards.
 
      - hexdigest():    Like digest() except the digest is
                        returned as a string of double length,
@@ -35,337 +46,306 @@
 
     For example, to obtain the digest of the string 'Hello World':
 
-        >>> import slowsha
-        >>> m = slowsha.sha1(b"Hello World")
+        >>> import _slowsha
+        >>> m = _slowsha.sha1('Hello ')
+        >>> m.update('World')
         >>> m.digest()
-        b'\\nMU\\xa8\\xd7x\\xe5\\x02/\\xabp\\x19w\\xc5\\xd8@\\xbb\\xc4\\x86\\xd0'
+        '\\nMU\\xa8\\xd7x\\xe5\\x02/\\xabp\\x19w\\xc5\\xd8@\\xbb\\xc4\\x86\\xd0'
 
     More condensed:
 
-        >>> slowsha.sha224(b"Hello World").hexdigest()
+        >>> _slowsha.sha224('Hello World').hexdigest()
         'c4890faffdb0105d991a461e668e276685401b02eab1ef4372795047'
 
 '''
 
-__version__ = "0.1"
-
-
-class SHA1 (object):
-
-    _h0, _h1, _h2, _h3, _h4, = (
-        0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
-
-    def __init__(self, message):
-        length = bin(len(message) * 8)[2:].rjust(64, "0")
-        while len(message) > 64:
-            self._handle(''.join(bin(i)[2:].rjust(8, "0")
-                for i in message[:64]))
-            message = message[64:]
-        message = ''.join(bin(i)[2:].rjust(8, "0") for i in message) + "1"
-        message += "0" * ((448 - len(message) % 512) % 512) + length
-        for i in range(len(message) // 512):
-            self._handle(message[i * 512:i * 512 + 512])
-
-
-    def _handle(self, chunk):
-
-        lrot = lambda x, n: (x << n) | (x >> (32 - n))
-        w = []
-
-        for j in range(len(chunk) // 32):
-            w.append(int(chunk[j * 32:j * 32 + 32], 2))
-
-        for i in range(16, 80):
-            w.append(lrot(w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16], 1)
-                & 0xffffffff)
-
-        a = self._h0
-        b = self._h1
-        c = self._h2
-        d = self._h3
-        e = self._h4
-
-        for i in range(80):
-
-            if i <= i <= 19:
-                f, k = d ^ (b & (c ^ d)), 0x5a827999
-            elif 20 <= i <= 39:
-                f, k = b ^ c ^ d, 0x6ed9eba1
-            elif 40 <= i <= 59:
-                f, k = (b & c) | (d & (b | c)), 0x8f1bbcdc
-            elif 60 <= i <= 79:
-                f, k = b ^ c ^ d, 0xca62c1d6
-
-            temp = lrot(a, 5) + f + e + k + w[i] & 0xffffffff
-            a, b, c, d, e = temp, a, lrot(b, 30), c, d
-
-        self._h0 = (self._h0 + a) & 0xffffffff
-        self._h1 = (self._h1 + b) & 0xffffffff
-        self._h2 = (self._h2 + c) & 0xffffffff
-        self._h3 = (self._h3 + d) & 0xffffffff
-        self._h4 = (self._h4 + e) & 0xffffffff
-
-    def _digest(self):
-        return (self._h0, self._h1, self._h2, self._h3, self._h4)
-
-    def hexdigest(self):
-        return ''.join(hex(i)[2:].rjust(8, "0").rstrip("L")
-            for i in self._digest())
+import struct
+
+__version__ = "0.2"
+
+M32 = 0xffffffff
+M64 = 0xffffffffffffffff
+
+_K256 = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5,
+    0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc,
+    0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7,
+    0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3,
+    0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5,
+    0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+
+_K512 = (
+    0x428a2f98d728ae22, 0x7137449123ef65cd,
+    0xb5c0fbcfec4d3b2f, 0xe9b5dba58189dbbc,
+    0x3956c25bf348b538, 0x59f111f1b605d019,
+    0x923f82a4af194f9b, 0xab1c5ed5da6d8118,
+    0xd807aa98a3030242, 0x12835b0145706fbe,
+    0x243185be4ee4b28c, 0x550c7dc3d5ffb4e2,
+    0x72be5d74f27b896f, 0x80deb1fe3b1696b1,
+    0x9bdc06a725c71235, 0xc19bf174cf692694,
+    0xe49b69c19ef14ad2, 0xefbe4786384f25e3,
+    0x0fc19dc68b8cd5b5, 0x240ca1cc77ac9c65,
+    0x2de92c6f592b0275, 0x4a7484aa6ea6e483,
+    0x5cb0a9dcbd41fbd4, 0x76f988da831153b5,
+    0x983e5152ee66dfab, 0xa831c66d2db43210,
+    0xb00327c898fb213f, 0xbf597fc7beef0ee4,
+    0xc6e00bf33da88fc2, 0xd5a79147930aa725,
+    0x06ca6351e003826f, 0x142929670a0e6e70,
+    0x27b70a8546d22ffc, 0x2e1b21385c26c926,
+    0x4d2c6dfc5ac42aed, 0x53380d139d95b3df,
+    0x650a73548baf63de, 0x766a0abb3c77b2a8,
+    0x81c2c92e47edaee6, 0x92722c851482353b,
+    0xa2bfe8a14cf10364, 0xa81a664bbc423001,
+    0xc24b8b70d0f89791, 0xc76c51a30654be30,
+    0xd192e819d6ef5218, 0xd69906245565a910,
+    0xf40e35855771202a, 0x106aa07032bbd1b8,
+    0x19a4c116b8d2d0c8, 0x1e376c085141ab53,
+    0x2748774cdf8eeb99, 0x34b0bcb5e19b48a8,
+    0x391c0cb3c5c95a63, 0x4ed8aa4ae3418acb,
+    0x5b9cca4f7763e373, 0x682e6ff3d6b2b8a3,
+    0x748f82ee5defb2fc, 0x78a5636f43172f60,
+    0x84c87814a1f0ab72, 0x8cc702081a6439ec,
+    0x90befffa23631e28, 0xa4506cebde82bde9,
+    0xbef9a3f7b2c67915, 0xc67178f2e372532b,
+    0xca273eceea26619c, 0xd186b8c721c0c207,
+    0xeada7dd6cde0eb1e, 0xf57d4f7fee6ed178,
+    0x06f067aa72176fba, 0x0a637dc5a2c898a6,
+    0x113f9804bef90dae, 0x1b710b35131c471b,
+    0x28db77f523047d84, 0x32caab7b40c72493,
+    0x3c9ebe0a15c9bebc, 0x431d67c49c100d4c,
+    0x4cc5d4becb3e42b6, 0x597f299cfc657e2a,
+    0x5fcb6fab3ad6faec, 0x6c44198c4a475817)
+
+
+class _sha (object):
+    ''' Buffering and padding shared by all the hash objects below.
+
+    Subclasses set _iv (initial chaining value), _words (number of output
+    words), _block (a struct.Struct for one block), _length_bytes (size
+    of the length field) and _compress(h, w), which updates the chaining
+    value h in place from the block words w. '''
+
+    def __init__(self, message=''):
+        self._h = list(self._iv)
+        self._buffer = ''
+        self._length = 0
+        if message:
+            self.update(message)
+
+    def update(self, message):
+        size = self._block.size
+        self._length += len(message)
+        pos = 0
+        if self._buffer:
+            pos = size - len(self._buffer)
+            self._buffer += message[:pos]
+            if len(self._buffer) < size:
+                return
+            self._compress(self._h, self._block.unpack(self._buffer))
+        end = len(message) - (len(message) - pos) % size
+        h = self._h
+        compress = self._compress
+        unpack_from = self._block.unpack_from
+        for i in xrange(pos, end, size):
+            compress(h, unpack_from(message, i))
+        self._buffer = message[end:]
+
+    def copy(self):
+        other = self.__class__.__new__(self.__class__)
+        other._h = self._h[:]
+        other._buffer = self._buffer
+        other._length = self._length
+        return other
 
     def digest(self):
-        hexdigest = self.hexdigest()
-        return hexdigest.decode('hex')
-
-
-class sha2_32 (object):
-    ''' Superclass for both 32 bit SHA2 objects (SHA224 and SHA256) '''
-
-    def __init__(self, message):
-        length = bin(len(message) * 8)[2:].rjust(64, "0")
-        while len(message) > 64:
-            self._handle(''.join(bin(i)[2:].rjust(8, "0")
-                for i in message[:64]))
-            message = message[64:]
-        message = ''.join(bin(i)[2:].rjust(8, "0") for i in message) + "1"
-        message += "0" * ((448 - len(message) % 512) % 512) + length
-        for i in range(len(message) // 512):
-            self._handle(message[i * 512:i * 512 + 512])
-
-    def _handle(self, chunk):
-
-        rrot = lambda x, n: (x >> n) | (x << (32 - n))
-        w = []
-
-        k = [
-            0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5,
-            0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
-            0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
-            0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
-            0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc,
-            0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
-            0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7,
-            0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
-            0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
-            0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
-            0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3,
-            0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
-            0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5,
-            0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
-            0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
-            0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
-
-        for j in range(len(chunk) // 32):
-            w.append(int(chunk[j * 32:j * 32 + 32], 2))
-
-        for i in range(16, 64):
-            s0 = rrot(w[i - 15], 7) ^ rrot(w[i - 15], 18) ^ (w[i - 15] >> 3)
-            s1 = rrot(w[i - 2], 17) ^ rrot(w[i - 2], 19) ^ (w[i - 2] >> 10)
-            w.append((w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffff)
-
-        a = self._h0
-        b = self._h1
-        c = self._h2
-        d = self._h3
-        e = self._h4
-        f = self._h5
-        g = self._h6
-        h = self._h7
-
-        for i in range(64):
-            s0 = rrot(a, 2) ^ rrot(a, 13) ^ rrot(a, 22)
-            maj = (a & b) ^ (a & c) ^ (b & c)
-            t2 = s0 + maj
-            s1 = rrot(e, 6) ^ rrot(e, 11) ^ rrot(e, 25)
-            ch = (e & f) ^ ((~ e) & g)
-            t1 = h + s1 + ch + k[i] + w[i]
-
-            h = g
-            g = f
-            f = e
-            e = (d + t1) & 0xffffffff
-            d = c
-            c = b
-            b = a
-            a = (t1 + t2) & 0xffffffff
-
-        self._h0 = (self._h0 + a) & 0xffffffff
-        self._h1 = (self._h1 + b) & 0xffffffff
-        self._h2 = (self._h2 + c) & 0xffffffff
-        self._h3 = (self._h3 + d) & 0xffffffff
-        self._h4 = (self._h4 + e) & 0xffffffff
-        self._h5 = (self._h5 + f) & 0xffffffff
-        self._h6 = (self._h6 + g) & 0xffffffff
-        self._h7 = (self._h7 + h) & 0xffffffff
+        size = self._block.size
+        h = self._h[:]
+        tail = self._buffer + '\x80'
+        tail += '\0' * ((size - self._length_bytes - len(tail)) % size)
+        tail += ('%0*x' % (self._length_bytes * 2, self._length * 8)) \
+            .decode('hex')
+        for i in xrange(0, len(tail), size):
+            self._compress(h, self._block.unpack_from(tail, i))
+        return struct.pack(self._digest_format, *h[:self._words])
 
     def hexdigest(self):
-        return ''.join(hex(i)[2:].rjust(8, "0").rstrip("L")
-            for i in self._digest())
-
-    def digest(self):
-        hexdigest = self.hexdigest()
-        return hexdigest.decode('hex')
-
+        return self.digest().encode('hex')
+
+
+class SHA1 (_sha):
+
+    _iv = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
+    _words = 5
+    _digest_format = '>5I'
+    _block = struct.Struct('>16I')
+    _length_bytes = 8
+    digest_size = 20
+    block_size = 64
+
+    @staticmethod
+    def _compress(h, block):
+        w = list(block)
+        for i in xrange(16, 80):
+            x = w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16]
+            w.append(((x << 1) | (x >> 31)) & M32)
+
+        a, b, c, d, e = h
+
+        for i in xrange(0, 20):
+            t = (((a << 5) | (a >> 27)) + (d ^ (b & (c ^ d))) + e
+                + 0x5a827999 + w[i]) & M32
+            a, b, c, d, e = t, a, ((b << 30) | (b >> 2)) & M32, c, d
+        for i in xrange(20, 40):
+            t = (((a << 5) | (a >> 27)) + (b ^ c ^ d) + e
+                + 0x6ed9eba1 + w[i]) & M32
+            a, b, c, d, e = t, a, ((b << 30) | (b >> 2)) & M32, c, d
+        for i in xrange(40, 60):
+            t = (((a << 5) | (a >> 27)) + ((b & c) | (d & (b | c))) + e
+                + 0x8f1bbcdc + w[i]) & M32
+            a, b, c, d, e = t, a, ((b << 30) | (b >> 2)) & M32, c, d
+        for i in xrange(60, 80):
+            t = (((a << 5) | (a >> 27)) + (b ^ c ^ d) + e
+                + 0xca62c1d6 + w[i]) & M32
+            a, b, c, d, e = t, a, ((b << 30) | (b >> 2)) & M32, c, d
+
+        h[0] = (h[0] + a) & M32
+        h[1] = (h[1] + b) & M32
+        h[2] = (h[2] + c) & M32
+        h[3] = (h[3] + d) & M32
+        h[4] = (h[4] + e) & M32
+
+
+class sha2_32 (_sha):
+    ''' Superclass for both 32 bit SHA2 objects (SHA224 and SHA256) '''
 
-class sha2_64 (object):
+    _block = struct.Struct('>16I')
+    _length_bytes = 8
+    block_size = 64
+
+    @staticmethod
+    def _compress(h, block):
+        w = list(block)
+        for i in xrange(16, 64):
+            x = w[i - 15]
+            y = w[i - 2]
+            s0 = ((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)
+            s1 = ((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)
+            w.append((w[i - 16] + s0 + w[i - 7] + s1) & M32)
+
+        a, b, c, d, e, f, g, hh = h
+
+        for i in xrange(64):
+            s1 = ((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) \
+                ^ ((e >> 25) | (e << 7))
+            t1 = hh + (s1 & M32) + (g ^ (e & (f ^ g))) + _K256[i] + w[i]
+            s0 = ((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) \
+                ^ ((a >> 22) | (a << 10))
+            t2 = (s0 & M32) + ((a & b) | (c & (a | b)))
+            hh, g, f, e = g, f, e, (d + t1) & M32
+            d, c, b, a = c, b, a, (t1 + t2) & M32
+
+        h[0] = (h[0] + a) & M32
+        h[1] = (h[1] + b) & M32
+        h[2] = (h[2] + c) & M32
+        h[3] = (h[3] + d) & M32
+        h[4] = (h[4] + e) & M32
+        h[5] = (h[5] + f) & M32
+        h[6] = (h[6] + g) & M32
+        h[7] = (h[7] + hh) & M32
+
+
+class sha2_64 (_sha):
     ''' Superclass for both 64 bit SHA2 objects (SHA384 and SHA512) '''
 
-    def __init__(self, message):
-        length = bin(len(message) * 8)[2:].rjust(128, "0")
-        while len(message) > 128:
-            self._handle(''.join(bin(i)[2:].rjust(8, "0")
-                for i in message[:128]))
-            message = message[128:]
-        message = ''.join(bin(i)[2:].rjust(8, "0") for i in message) + "1"
-        message += "0" * ((896 - len(message) % 1024) % 1024) + length
-        for i in range(len(message) // 1024):
-            self._handle(message[i * 1024:i * 1024 + 1024])
-
-    def _handle(self, chunk):
-
-        rrot = lambda x, n: (x >> n) | (x << (64 - n))
-        w = []
-
-        k = [
-            0x428a2f98d728ae22, 0x7137449123ef65cd,
-            0xb5c0fbcfec4d3b2f, 0xe9b5dba58189dbbc,
-            0x3956c25bf348b538, 0x59f111f1b605d019,
-            0x923f82a4af194f9b, 0xab1c5ed5da6d8118,
-            0xd807aa98a3030242, 0x12835b0145706fbe,
-            0x243185be4ee4b28c, 0x550c7dc3d5ffb4e2,
-            0x72be5d74f27b896f, 0x80deb1fe3b1696b1,
-            0x9bdc06a725c71235, 0xc19bf174cf692694,
-            0xe49b69c19ef14ad2, 0xefbe4786384f25e3,
-            0x0fc19dc68b8cd5b5, 0x240ca1cc77ac9c65,
-            0x2de92c6f592b0275, 0x4a7484aa6ea6e483,
-            0x5cb0a9dcbd41fbd4, 0x76f988da831153b5,
-            0x983e5152ee66dfab, 0xa831c66d2db43210,
-            0xb00327c898fb213f, 0xbf597fc7beef0ee4,
-            0xc6e00bf33da88fc2, 0xd5a79147930aa725,
-            0x06ca6351e003826f, 0x142929670a0e6e70,
-            0x27b70a8546d22ffc, 0x2e1b21385c26c926,
-            0x4d2c6dfc5ac42aed, 0x53380d139d95b3df,
-            0x650a73548baf63de, 0x766a0abb3c77b2a8,
-            0x81c2c92e47edaee6, 0x92722c851482353b,
-            0xa2bfe8a14cf10364, 0xa81a664bbc423001,
-            0xc24b8b70d0f89791, 0xc76c51a30654be30,
-            0xd192e819d6ef5218, 0xd69906245565a910,
-            0xf40e35855771202a, 0x106aa07032bbd1b8,
-            0x19a4c116b8d2d0c8, 0x1e376c085141ab53,
-            0x2748774cdf8eeb99, 0x34b0bcb5e19b48a8,
-            0x391c0cb3c5c95a63, 0x4ed8aa4ae3418acb,
-            0x5b9cca4f7763e373, 0x682e6ff3d6b2b8a3,
-            0x748f82ee5defb2fc, 0x78a5636f43172f60,
-            0x84c87814a1f0ab72, 0x8cc702081a6439ec,
-            0x90befffa23631e28, 0xa4506cebde82bde9,
-            0xbef9a3f7b2c67915, 0xc67178f2e372532b,
-            0xca273eceea26619c, 0xd186b8c721c0c207,
-            0xeada7dd6cde0eb1e, 0xf57d4f7fee6ed178,
-            0x06f067aa72176fba, 0x0a637dc5a2c898a6,
-            0x113f9804bef90dae, 0x1b710b35131c471b,
-            0x28db77f523047d84, 0x32caab7b40c72493,
-            0x3c9ebe0a15c9bebc, 0x431d67c49c100d4c,
-            0x4cc5d4becb3e42b6, 0x597f299cfc657e2a,
-            0x5fcb6fab3ad6faec, 0x6c44198c4a475817]
-
-        for j in range(len(chunk) // 64):
-            w.append(int(chunk[j * 64:j * 64 + 64], 2))
-
-        for i in range(16, 80):
-            s0 = rrot(w[i - 15], 1) ^ rrot(w[i - 15], 8) ^ (w[i - 15] >> 7)
-            s1 = rrot(w[i - 2], 19) ^ rrot(w[i - 2], 61) ^ (w[i - 2] >> 6)
-            w.append((w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffffffffffff)
-
-        a = self._h0
-        b = self._h1
-        c = self._h2
-        d = self._h3
-        e = self._h4
-        f = self._h5
-        g = self._h6
-        h = self._h7
-
-        for i in range(80):
-            s0 = rrot(a, 28) ^ rrot(a, 34) ^ rrot(a, 39)
-            maj = (a & b) ^ (a & c) ^ (b & c)
-            t2 = s0 + maj
-            s1 = rrot(e, 14) ^ rrot(e, 18) ^ rrot(e, 41)
-            ch = (e & f) ^ ((~ e) & g)
-            t1 = h + s1 + ch + k[i] + w[i]
-
-            h = g
-            g = f
-            f = e
-            e = (d + t1) & 0xffffffffffffffff
-            d = c
-            c = b
-            b = a
-            a = (t1 + t2) & 0xffffffffffffffff
-
-        self._h0 = (self._h0 + a) & 0xffffffffffffffff
-        self._h1 = (self._h1 + b) & 0xffffffffffffffff
-        self._h2 = (self._h2 + c) & 0xffffffffffffffff
-        self._h3 = (self._h3 + d) & 0xffffffffffffffff
-        self._h4 = (self._h4 + e) & 0xffffffffffffffff
-        self._h5 = (self._h5 + f) & 0xffffffffffffffff
-        self._h6 = (self._h6 + g) & 0xffffffffffffffff
-        self._h7 = (self._h7 + h) & 0xffffffffffffffff
-
-    def hexdigest(self):
-        return ''.join(hex(i)[2:].rjust(16, "0").rstrip("L")
-            for i in self._digest())
-
-    def digest(self):
-        hexdigest = self.hexdigest()
-        return hexdigest.decode('hex')
+    _block = struct.Struct('>16Q')
+    _length_bytes = 16
+    block_size = 128
+
+    @staticmethod
+    def _compress(h, block):
+        w = list(block)
+        for i in xrange(16, 80):
+            x = w[i - 15]
+            y = w[i - 2]
+            s0 = ((x >> 1) | (x << 63)) ^ ((x >> 8) | (x << 56)) ^ (x >> 7)
+            s1 = ((y >> 19) | (y << 45)) ^ ((y >> 61) | (y << 3)) ^ (y >> 6)
+            w.append((w[i - 16] + s0 + w[i - 7] + s1) & M64)
+
+        a, b, c, d, e, f, g, hh = h
+
+        for i in xrange(80):
+            s1 = ((e >> 14) | (e << 50)) ^ ((e >> 18) | (e << 46)) \
+                ^ ((e >> 41) | (e << 23))
+            t1 = hh + (s1 & M64) + (g ^ (e & (f ^ g))) + _K512[i] + w[i]
+            s0 = ((a >> 28) | (a << 36)) ^ ((a >> 34) | (a << 30)) \
+                ^ ((a >> 39) | (a << 25))
+            t2 = (s0 & M64) + ((a & b) | (c & (a | b)))
+            hh, g, f, e = g, f, e, (d + t1) & M64
+            d, c, b, a = c, b, a, (t1 + t2) & M64
+
+        h[0] = (h[0] + a) & M64
+        h[1] = (h[1] + b) & M64
+        h[2] = (h[2] + c) & M64
+        h[3] = (h[3] + d) & M64
+        h[4] = (h[4] + e) & M64
+        h[5] = (h[5] + f) & M64
+        h[6] = (h[6] + g) & M64
+        h[7] = (h[7] + hh) & M64
 
 
 class SHA224 (sha2_32):
 
-    _h0, _h1, _h2, _h3, _h4, _h5, _h6, _h7 = (
+    _iv = (
         0xc1059ed8, 0x367cd507, 0x3070dd17, 0xf70e5939,
         0xffc00b31, 0x68581511, 0x64f98fa7, 0xbefa4fa4)
-
-    def _digest(self):
-        return (self._h0, self._h1, self._h2, self._h3,
-            self._h4, self._h5, self._h6)
+    _words = 7
+    _digest_format = '>7I'
+    digest_size = 28
 
 
 class SHA256 (sha2_32):
 
-    _h0, _h1, _h2, _h3, _h4, _h5, _h6, _h7 = (
+    _iv = (
         0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
         0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
-
-    def _digest(self):
-        return (self._h0, self._h1, self._h2, self._h3,
-            self._h4, self._h5, self._h6, self._h7)
+    _words = 8
+    _digest_format = '>8I'
+    digest_size = 32
 
 
 class SHA512 (sha2_64):
 
-    _h0, _h1, _h2, _h3, _h4, _h5, _h6, _h7 = (
+    _iv = (
         0x6a09e667f3bcc908, 0xbb67ae8584caa73b, 0x3c6ef372fe94f82b,
         0xa54ff53a5f1d36f1, 0x510e527fade682d1, 0x9b05688c2b3e6c1f,
         0x1f83d9abfb41bd6b, 0x5be0cd19137e2179)
-
-    def _digest(self):
-        return (self._h0, self._h1, self._h2, self._h3,
-            self._h4, self._h5, self._h6, self._h7)
+    _words = 8
+    _digest_format = '>8Q'
+    digest_size = 64
 
 
 class SHA384 (sha2_64):
 
-    _h0, _h1, _h2, _h3, _h4, _h5, _h6, _h7 = (
+    _iv = (
         0xcbbb9d5dc1059ed8, 0x629a292a367cd507, 0x9159015a3070dd17,
         0x152fecd8f70e5939, 0x67332667ffc00b31, 0x8eb44a8768581511,
         0xdb0c2e0d64f98fa7, 0x47b5481dbefa4fa4)
+    _words = 6
+    _digest_format = '>6Q'
+    digest_size = 48
 
-    def _digest(self):
-        return (self._h0, self._h1, self._h2, self._h3,
-            self._h4, self._h5)
 
-
-def new(algorithm, message):
+def new(algorithm, message=''):
     obj = {
         'sha1': SHA1,
         'sha224': SHA224,
@@ -376,53 +356,81 @@ def new(algorithm, message):
     return obj
 
 
-def sha1(message):
+def sha1(message=''):
     ''' Returns a new sha1 hash object '''
     return new('sha1', message)
 
 
-def sha224(message):
+def sha224(message=''):
     ''' Returns a new sha224 hash object '''
     return new('sha224', message)
 
 
-def sha256(message):
+def sha256(message=''):
     ''' Returns a new sha256 hash object '''
     return new('sha256', message)
 
 
-def sha384(message):
+def sha384(message=''):
     ''' Returns a new sha384 hash object '''
     return new('sha384', message)
 
 
-def sha512(message):
+def sha512(message=''):
     ''' Returns a new sha512 hash object '''
     return new('sha512', message)
 
 
 __all__ = ('sha1', 'sha224', 'sha256', 'sha384', 'sha512')
 
+
+def _selftest():
+    vectors = {
+        'sha1': 'a9993e364706816aba3e25717850c26c9cd0d89d',
+        'sha224': '23097d223405d8228642a477bda255b3'
+                  '2aadbce4bda0b3f7e36c9da7',
+        'sha256': 'ba7816bf8f01cfea414140de5dae2223'
+                  'b00361a396177a9cb410ff61f20015ad',
+        'sha384': 'cb00753f45a35e8bb5a03d699ac65007272c32ab0eded163'
+                  '1a8b605a43ff5bed8086072ba1e7cc2358baeca134c825a7',
+        'sha512': 'ddaf35a193617abacc417349ae20413112e6fa4e89a97ea2'
+                  '0a9eeee64b55d39a2192992a274fc1a836ba3c23a3feebbd'
+                  '454d4423643ce80e2a9ac94fa54ca49f',
+    }
+    for name in __all__:
+        assert new(name, 'abc').hexdigest() == vectors[name]
+        obj = new(name, 'a')
+        obj.copy().update('x')
+        obj.update('bc')
+        assert obj.hexdigest() == vectors[name]
+
+
 if __name__ == '__main__':
+    _selftest()
     import os
     import hashlib
     vectors = [
-        b'',
-        b'abc',
-        b'The quick brown fox jumped over the lazy dog',
-        b'The quick brown fox jumped over the lazy dog.',
-        b"abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq",
+        '',
+        'abc',
+        'The quick brown fox jumped over the lazy dog',
+        'The quick brown fox jumped over the lazy dog.',
+        "abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq",
         os.urandom(1200),
     ]
-    for i in vectors:
-        assert hashlib.sha1(i).hexdigest() == sha1(i).hexdigest()
-        assert hashlib.sha224(i).hexdigest() == sha224(i).hexdigest()
-        assert hashlib.sha256(i).hexdigest() == sha256(i).hexdigest()
-        assert hashlib.sha384(i).hexdigest() == sha384(i).hexdigest()
-        assert hashlib.sha512(i).hexdigest() == sha512(i).hexdigest()
-        assert hashlib.sha1(i).digest() == sha1(i).digest()
-        assert hashlib.sha224(i).digest() == sha224(i).digest()
-        assert hashlib.sha256(i).digest() == sha256(i).digest()
-        assert hashlib.sha384(i).digest() == sha384(i).digest()
-        assert hashlib.sha512(i).digest() == sha512(i).digest()
+    for name in __all__:
+        for i in vectors:
+            reference = hashlib.new(name, i)
+            assert reference.hexdigest() == new(name, i).hexdigest()
+            assert reference.digest() == new(name, i).digest()
+            # Feed the same message in uneven pieces.
+            obj = new(name)
+            for j in xrange(0, len(i), 7):
+                obj.update(i[j:j + 7])
+            assert obj.copy().digest() == reference.digest()
+            obj.update('tail')
+            reference.update('tail')
+            assert obj.digest() == reference.digest()
     print("all tests passed")
+else:
+    from cryptoalgo import selftest
+    selftest.verify('SHA', _selftest)
@@ -162,8 +162,22 @@ class md5:
         self.__dict__.clear()
 
         return digest
-    
-    digest = final  # alias
+
+##/* Copy of the context and non-destructive digest, as in hashlib.
+## */
+
+    def copy(self):
+        other = md5()
+        other.count = self.count
+        other.state = self.state
+        other.buffer = self.buffer
+        return other
+
+    def digest(self):
+        return self.copy().final()
+
+    def hexdigest(self):
+        return self.digest().encode('hex')
 
 ##/* MD5 basic transformation. Transforms state based on block.
 ## */
@@ -297,6 +311,26 @@ class hash_class:
     def hash(self, text):
         return md5class(text).digest()
 
-if __name__ == '__main__':
+    def new(self, text=''):
+        """Return an incremental hash object with update(), copy() and
+        digest()."""
+        return md5class(text)
+
+def _selftest():
+    # Check the pure implementation, whatever md5class turned out to be.
+    assert md5('').digest().encode('hex') == \
+        'd41d8cd98f00b204e9800998ecf8427e'
+    context = md5('a')
+    context.copy().update('x')
+    assert context.digest().encode('hex') == \
+        '0cc175b9c0f1b6a831c399e269772661'
+    context.update('bc')
+    assert context.hexdigest() == '900150983cd24fb0d6963f7d28e17f72'
     assert hash_class().hash('').encode('hex') == \
         'd41d8cd98f00b204e9800998ecf8427e'
+
+if __name__ == '__main__':
+    _selftest()
+else:
+    from cryptoalgo import selftest
+    selftest.verify('MD5', _selftest)
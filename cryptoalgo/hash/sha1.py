@@ -1,4 +1,7 @@
-import hashlib
+try:
+    from hashlib import sha1 as sha1class
+except ImportError:
+    from _slowsha import sha1 as sha1class
 
 class hash_class:
 
@@ -15,4 +18,9 @@ class hash_class:
         return 512
 
     def hash(self, text):
-        return hashlib.sha1(text).digest()
+        return sha1class(text).digest()
+
+    def new(self, text=''):
+        """Return an incremental hash object with update(), copy() and
+        digest()."""
+        return sha1class(text)
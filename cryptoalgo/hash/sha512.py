@@ -1,4 +1,7 @@
-import hashlib
+try:
+    from hashlib import sha512 as sha512class
+except ImportError:
+    from _slowsha import sha512 as sha512class
 
 class hash_class:
 
@@ -15,4 +18,9 @@ class hash_class:
         return 1024
 
     def hash(self, text):
-        return hashlib.sha512(text).digest()
+        return sha512class(text).digest()
+
+    def new(self, text=''):
+        """Return an incremental hash object with update(), copy() and
+        digest()."""
+        return sha512class(text)
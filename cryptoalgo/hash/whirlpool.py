@@ -26,6 +26,8 @@
 ##
 ## This Python implementation is therefore also placed in the public domain.
 
+import struct
+
 try:
     import psyco
     psyco.full()
@@ -40,6 +42,9 @@ class Whirlpool:
     """Return a new Whirlpool object. An optional string argument
     may be provided; if present, this string will be automatically
     hashed."""
+    digest_size = 64
+    block_size = 64
+
     def __init__(self, arg=None):
         self.ctx = WhirlpoolStruct()
         if arg:
@@ -48,7 +53,7 @@ class Whirlpool:
         
     def update(self, arg):
         """update(arg)"""
-        WhirlpoolAdd(arg, len(arg)*8, self.ctx)
+        WhirlpoolAdd(arg, self.ctx)
         self.digest_status = 0
         
     def digest(self):
@@ -60,17 +65,19 @@ class Whirlpool:
     
     def hexdigest(self):
         """hexdigest()"""
-        dig = self.digest()
-        tempstr = ''
-        for d in dig:
-            xxx = '%02x' % (ord(d))
-            tempstr = tempstr + xxx
-        return tempstr
+        return self.digest().encode('hex')
     
     def copy(self):
-        """copy()"""
-        import copy
-        return copy.deepcopy(self)
+        """copy()
+
+        The copy continues from the same state and is independent of the
+        original, so a common prefix only needs to be hashed once."""
+        other = Whirlpool()
+        other.ctx = WhirlpoolCopy(self.ctx)
+        other.digest_status = self.digest_status
+        if self.digest_status:
+            other.dig = self.dig
+        return other
     
 
 def new(init=None):
@@ -79,6 +86,32 @@ def new(init=None):
     hashed."""
     return Whirlpool(init)
 
+def hash_many(messages):
+    """Return the digests of a list of strings, in the same order.
+
+    With NumPy installed, messages of the same padded length are hashed
+    in lockstep, each table lookup gathering over the whole group.
+    Otherwise every message is hashed on its own."""
+    try:
+        import numpy
+    except ImportError:
+        return [Whirlpool(m).digest() for m in messages]
+
+    groups = {}
+    for i in xrange(len(messages)):
+        padded = _pad(messages[i], len(messages[i]))
+        groups.setdefault(len(padded), []).append((i, padded))
+
+    digests = [None] * len(messages)
+    for size in groups:
+        group = groups[size]
+        blocks = numpy.frombuffer(''.join([p for i, p in group]), '>u8')
+        hash = _hash_lockstep(numpy, blocks.reshape(len(group), size / 8))
+        hash = hash.astype('>u8').tostring()
+        for n in xrange(len(group)):
+            digests[group[n][0]] = hash[64 * n:64 * (n + 1)]
+    return digests
+
 #
 # Private.
 #
@@ -629,170 +662,181 @@ rc = [
 ]
 
 DIGESTBYTES = 64
+_C = (C0, C1, C2, C3, C4, C5, C6, C7)
+_RC = rc[1:R+1]
+_BLOCK = struct.Struct('>8Q')
+
 class WhirlpoolStruct:
     def __init__(self):
-        self.bitLength = [0]*32
-        self.buffer = [0]*64
-        self.bufferBits = 0
-        self.bufferPos = 0
+        self.length = 0     # bytes hashed so far
+        self.buffer = ''    # pending input, always shorter than a block
         self.hash = [0]*8
 
 def WhirlpoolInit(ctx):
     ctx = WhirlpoolStruct()
     return
 
-def WhirlpoolAdd(source, sourceBits, ctx):
-    source = [ord(s)&0xff for s in source]
-    
-    carry = 0
-    value = sourceBits
-    i = 31
-    while i >= 0 and value != 0:
-        carry += ctx.bitLength[i] + ((value % 0x100000000) & 0xff)
-        ctx.bitLength[i] = carry % 0x100
-        carry >>= 8
-        value >>= 8
-        i -= 1
-
-    bufferBits = ctx.bufferBits
-    bufferPos = ctx.bufferPos
-    sourcePos = 0
-    sourceGap = (8 - (sourceBits & 7)) & 7
-    bufferRem = ctx.bufferBits & 7
-    buffr = ctx.buffer
-    
-    while sourceBits > 8:
-        b = ((source[sourcePos] << sourceGap) & 0xff) | ((source[sourcePos + 1] & 0xff) >> (8 - sourceGap))
-        buffr[bufferPos] |= (b >> bufferRem) % 0x100
-        bufferPos += 1
-        bufferBits += 8 - bufferRem
-        if bufferBits == 512:
-            processBuffer(ctx)
-            bufferBits = 0
-            bufferPos = 0
-
-        buffr[bufferPos] = b << (8 - bufferRem)
-        bufferBits += bufferRem
-        
-        sourceBits -= 8
-        sourcePos += 1
-
-    b = (source[sourcePos] << sourceGap) & 0xff
-    buffr[bufferPos] |= b >> bufferRem
-    if bufferRem + sourceBits < 8:
-        bufferBits += sourceBits
-    else:
-        bufferPos += 1
-        bufferBits += 8 - bufferRem
-        sourceBits -= 8 - bufferRem
-        if bufferBits == 512:
-            processBuffer(ctx)
-            bufferBits = 0
-            bufferPos = 0
-        buffr[bufferPos] = b << (8 - bufferRem)
-        bufferBits += sourceBits
-    ctx.bufferBits = bufferBits
-    ctx.bufferPos = bufferPos
+def WhirlpoolCopy(ctx):
+    other = WhirlpoolStruct()
+    other.length = ctx.length
+    other.buffer = ctx.buffer
+    other.hash = ctx.hash[:]
+    return other
+
+def WhirlpoolAdd(source, ctx):
+    """Hash a string. Whole 64-byte blocks are read straight from the
+    input; only the remainder is kept in the buffer."""
+    ctx.length += len(source)
+    pos = 0
+    if ctx.buffer:
+        pos = 64 - len(ctx.buffer)
+        ctx.buffer += source[:pos]
+        if len(ctx.buffer) < 64:
+            return
+        processBuffer(ctx.hash, _BLOCK.unpack(ctx.buffer))
+    end = len(source) - (len(source) - pos) % 64
+    hash = ctx.hash
+    unpack_from = _BLOCK.unpack_from
+    for i in xrange(pos, end, 64):
+        processBuffer(hash, unpack_from(source, i))
+    ctx.buffer = source[end:]
+
+def _pad(tail, length):
+    """Append the padding and the 256-bit length (in bytes) of the whole
+    message to its last, partial block 'tail'."""
+    tail += '\x80'
+    tail += '\0' * ((32 - len(tail)) % 64)
+    return tail + ('%064x' % (length * 8)).decode('hex')
 
 def WhirlpoolFinalize(ctx):
-    bufferPos = ctx.bufferPos
-    ctx.buffer[bufferPos] |= 0x80 >> (ctx.bufferBits & 7)
-    bufferPos += 1
-    if bufferPos > 32:
-        if bufferPos < 64:
-            for i in xrange(64 - bufferPos):
-                ctx.buffer[bufferPos+i] = 0
-        processBuffer(ctx)
-        bufferPos = 0
-    if bufferPos < 32:
-        for i in xrange(32 - bufferPos):
-            ctx.buffer[bufferPos+i] = 0
-    bufferPos = 32
-    for i in xrange(32):
-        ctx.buffer[32+i] = ctx.bitLength[i]
-    processBuffer(ctx)
-    digest = ''
-    for i in xrange(8):
-        digest += chr((ctx.hash[i] >> 56) % 0x100)
-        digest += chr((ctx.hash[i] >> 48) % 0x100)
-        digest += chr((ctx.hash[i] >> 40) % 0x100)
-        digest += chr((ctx.hash[i] >> 32) % 0x100)
-        digest += chr((ctx.hash[i] >> 24) % 0x100)
-        digest += chr((ctx.hash[i] >> 16) % 0x100)
-        digest += chr((ctx.hash[i] >> 8) % 0x100)
-        digest += chr((ctx.hash[i]) % 0x100)
-    ctx.bufferPos = bufferPos
-    return digest
-
-def CDo(buf, a0, a1, a2, a3, a4, a5, a6, a7):
-    return C0[((buf[a0] >> 56) % 0x100000000) & 0xff] ^ \
-           C1[((buf[a1] >> 48) % 0x100000000) & 0xff] ^ \
-           C2[((buf[a2] >> 40) % 0x100000000) & 0xff] ^ \
-           C3[((buf[a3] >> 32) % 0x100000000) & 0xff] ^ \
-           C4[((buf[a4] >> 24) % 0x100000000) & 0xff] ^ \
-           C5[((buf[a5] >> 16) % 0x100000000) & 0xff] ^ \
-           C6[((buf[a6] >>  8) % 0x100000000) & 0xff] ^ \
-           C7[((buf[a7] >>  0) % 0x100000000) & 0xff]
-
-def processBuffer(ctx):
-    i, r = 0, 0
-    K = [0]*8
-    block = [0]*8
-    state = [0]*8
-    L = [0]*8
-    buffr = ctx.buffer
-
-    buf_cnt = 0
-    for i in xrange(8):
-        block[i] = ((buffr[buf_cnt+0] & 0xff) << 56) ^ \
-                   ((buffr[buf_cnt+1] & 0xff) << 48) ^ \
-                   ((buffr[buf_cnt+2] & 0xff) << 40) ^ \
-                   ((buffr[buf_cnt+3] & 0xff) << 32) ^ \
-                   ((buffr[buf_cnt+4] & 0xff) << 24) ^ \
-                   ((buffr[buf_cnt+5] & 0xff) << 16) ^ \
-                   ((buffr[buf_cnt+6] & 0xff) <<  8) ^ \
-                   ((buffr[buf_cnt+7] & 0xff) <<  0)
-        buf_cnt += 8
-    for i in xrange(8):
-        K[i] = ctx.hash[i]
-        state[i] = block[i] ^ K[i]
-        
-    for r in xrange(1, R+1):
-        L[0] = CDo(K, 0, 7, 6, 5, 4, 3, 2, 1) ^ rc[r]
-        L[1] = CDo(K, 1, 0, 7, 6, 5, 4, 3, 2)
-        L[2] = CDo(K, 2, 1, 0, 7, 6, 5, 4, 3)
-        L[3] = CDo(K, 3, 2, 1, 0, 7, 6, 5, 4)
-        L[4] = CDo(K, 4, 3, 2, 1, 0, 7, 6, 5)
-        L[5] = CDo(K, 5, 4, 3, 2, 1, 0, 7, 6)
-        L[6] = CDo(K, 6, 5, 4, 3, 2, 1, 0, 7)
-        L[7] = CDo(K, 7, 6, 5, 4, 3, 2, 1, 0)
-        for i in xrange(8):
-            K[i] = L[i]
-        L[0] = CDo(state, 0, 7, 6, 5, 4, 3, 2, 1) ^ K[0]
-        L[1] = CDo(state, 1, 0, 7, 6, 5, 4, 3, 2) ^ K[1]
-        L[2] = CDo(state, 2, 1, 0, 7, 6, 5, 4, 3) ^ K[2]
-        L[3] = CDo(state, 3, 2, 1, 0, 7, 6, 5, 4) ^ K[3]
-        L[4] = CDo(state, 4, 3, 2, 1, 0, 7, 6, 5) ^ K[4]
-        L[5] = CDo(state, 5, 4, 3, 2, 1, 0, 7, 6) ^ K[5]
-        L[6] = CDo(state, 6, 5, 4, 3, 2, 1, 0, 7) ^ K[6]
-        L[7] = CDo(state, 7, 6, 5, 4, 3, 2, 1, 0) ^ K[7]
-        for i in xrange(8):
-            state[i] = L[i]
+    """Return the digest of everything added to ctx so far. The context
+    itself is left untouched."""
+    hash = ctx.hash[:]
+    tail = _pad(ctx.buffer, ctx.length)
+    for i in xrange(0, len(tail), 64):
+        processBuffer(hash, _BLOCK.unpack_from(tail, i))
+    return _BLOCK.pack(*hash)
+
+def processBuffer(hash, block):
+    """Compress one block, given as 8 big-endian words, into the chaining
+    value 'hash' (a list of 8 words, updated in place)."""
+    C0, C1, C2, C3, C4, C5, C6, C7 = _C
+    k0, k1, k2, k3, k4, k5, k6, k7 = hash
+    b0, b1, b2, b3, b4, b5, b6, b7 = block
+    s0, s1, s2, s3 = b0 ^ k0, b1 ^ k1, b2 ^ k2, b3 ^ k3
+    s4, s5, s6, s7 = b4 ^ k4, b5 ^ k5, b6 ^ k6, b7 ^ k7
+
+    for r in _RC:
+        l0 = C0[k0 >> 56] ^ C1[(k7 >> 48) & 0xff] ^ \
+             C2[(k6 >> 40) & 0xff] ^ C3[(k5 >> 32) & 0xff] ^ \
+             C4[(k4 >> 24) & 0xff] ^ C5[(k3 >> 16) & 0xff] ^ \
+             C6[(k2 >> 8) & 0xff] ^ C7[k1 & 0xff] ^ r
+        l1 = C0[k1 >> 56] ^ C1[(k0 >> 48) & 0xff] ^ \
+             C2[(k7 >> 40) & 0xff] ^ C3[(k6 >> 32) & 0xff] ^ \
+             C4[(k5 >> 24) & 0xff] ^ C5[(k4 >> 16) & 0xff] ^ \
+             C6[(k3 >> 8) & 0xff] ^ C7[k2 & 0xff]
+        l2 = C0[k2 >> 56] ^ C1[(k1 >> 48) & 0xff] ^ \
+             C2[(k0 >> 40) & 0xff] ^ C3[(k7 >> 32) & 0xff] ^ \
+             C4[(k6 >> 24) & 0xff] ^ C5[(k5 >> 16) & 0xff] ^ \
+             C6[(k4 >> 8) & 0xff] ^ C7[k3 & 0xff]
+        l3 = C0[k3 >> 56] ^ C1[(k2 >> 48) & 0xff] ^ \
+             C2[(k1 >> 40) & 0xff] ^ C3[(k0 >> 32) & 0xff] ^ \
+             C4[(k7 >> 24) & 0xff] ^ C5[(k6 >> 16) & 0xff] ^ \
+             C6[(k5 >> 8) & 0xff] ^ C7[k4 & 0xff]
+        l4 = C0[k4 >> 56] ^ C1[(k3 >> 48) & 0xff] ^ \
+             C2[(k2 >> 40) & 0xff] ^ C3[(k1 >> 32) & 0xff] ^ \
+             C4[(k0 >> 24) & 0xff] ^ C5[(k7 >> 16) & 0xff] ^ \
+             C6[(k6 >> 8) & 0xff] ^ C7[k5 & 0xff]
+        l5 = C0[k5 >> 56] ^ C1[(k4 >> 48) & 0xff] ^ \
+             C2[(k3 >> 40) & 0xff] ^ C3[(k2 >> 32) & 0xff] ^ \
+             C4[(k1 >> 24) & 0xff] ^ C5[(k0 >> 16) & 0xff] ^ \
+             C6[(k7 >> 8) & 0xff] ^ C7[k6 & 0xff]
+        l6 = C0[k6 >> 56] ^ C1[(k5 >> 48) & 0xff] ^ \
+             C2[(k4 >> 40) & 0xff] ^ C3[(k3 >> 32) & 0xff] ^ \
+             C4[(k2 >> 24) & 0xff] ^ C5[(k1 >> 16) & 0xff] ^ \
+             C6[(k0 >> 8) & 0xff] ^ C7[k7 & 0xff]
+        l7 = C0[k7 >> 56] ^ C1[(k6 >> 48) & 0xff] ^ \
+             C2[(k5 >> 40) & 0xff] ^ C3[(k4 >> 32) & 0xff] ^ \
+             C4[(k3 >> 24) & 0xff] ^ C5[(k2 >> 16) & 0xff] ^ \
+             C6[(k1 >> 8) & 0xff] ^ C7[k0 & 0xff]
+        k0, k1, k2, k3, k4, k5, k6, k7 = l0, l1, l2, l3, l4, l5, l6, l7
+        l0 = C0[s0 >> 56] ^ C1[(s7 >> 48) & 0xff] ^ \
+             C2[(s6 >> 40) & 0xff] ^ C3[(s5 >> 32) & 0xff] ^ \
+             C4[(s4 >> 24) & 0xff] ^ C5[(s3 >> 16) & 0xff] ^ \
+             C6[(s2 >> 8) & 0xff] ^ C7[s1 & 0xff] ^ k0
+        l1 = C0[s1 >> 56] ^ C1[(s0 >> 48) & 0xff] ^ \
+             C2[(s7 >> 40) & 0xff] ^ C3[(s6 >> 32) & 0xff] ^ \
+             C4[(s5 >> 24) & 0xff] ^ C5[(s4 >> 16) & 0xff] ^ \
+             C6[(s3 >> 8) & 0xff] ^ C7[s2 & 0xff] ^ k1
+        l2 = C0[s2 >> 56] ^ C1[(s1 >> 48) & 0xff] ^ \
+             C2[(s0 >> 40) & 0xff] ^ C3[(s7 >> 32) & 0xff] ^ \
+             C4[(s6 >> 24) & 0xff] ^ C5[(s5 >> 16) & 0xff] ^ \
+             C6[(s4 >> 8) & 0xff] ^ C7[s3 & 0xff] ^ k2
+        l3 = C0[s3 >> 56] ^ C1[(s2 >> 48) & 0xff] ^ \
+             C2[(s1 >> 40) & 0xff] ^ C3[(s0 >> 32) & 0xff] ^ \
+             C4[(s7 >> 24) & 0xff] ^ C5[(s6 >> 16) & 0xff] ^ \
+             C6[(s5 >> 8) & 0xff] ^ C7[s4 & 0xff] ^ k3
+        l4 = C0[s4 >> 56] ^ C1[(s3 >> 48) & 0xff] ^ \
+             C2[(s2 >> 40) & 0xff] ^ C3[(s1 >> 32) & 0xff] ^ \
+             C4[(s0 >> 24) & 0xff] ^ C5[(s7 >> 16) & 0xff] ^ \
+             C6[(s6 >> 8) & 0xff] ^ C7[s5 & 0xff] ^ k4
+        l5 = C0[s5 >> 56] ^ C1[(s4 >> 48) & 0xff] ^ \
+             C2[(s3 >> 40) & 0xff] ^ C3[(s2 >> 32) & 0xff] ^ \
+             C4[(s1 >> 24) & 0xff] ^ C5[(s0 >> 16) & 0xff] ^ \
+             C6[(s7 >> 8) & 0xff] ^ C7[s6 & 0xff] ^ k5
+        l6 = C0[s6 >> 56] ^ C1[(s5 >> 48) & 0xff] ^ \
+             C2[(s4 >> 40) & 0xff] ^ C3[(s3 >> 32) & 0xff] ^ \
+             C4[(s2 >> 24) & 0xff] ^ C5[(s1 >> 16) & 0xff] ^ \
+             C6[(s0 >> 8) & 0xff] ^ C7[s7 & 0xff] ^ k6
+        l7 = C0[s7 >> 56] ^ C1[(s6 >> 48) & 0xff] ^ \
+             C2[(s5 >> 40) & 0xff] ^ C3[(s4 >> 32) & 0xff] ^ \
+             C4[(s3 >> 24) & 0xff] ^ C5[(s2 >> 16) & 0xff] ^ \
+             C6[(s1 >> 8) & 0xff] ^ C7[s0 & 0xff] ^ k7
+        s0, s1, s2, s3, s4, s5, s6, s7 = l0, l1, l2, l3, l4, l5, l6, l7
+
     # apply the Miyaguchi-Preneel compression function
-    for i in xrange(8):
-        ctx.hash[i] ^= state[i] ^ block[i]
-    return
+    hash[0] ^= s0 ^ b0
+    hash[1] ^= s1 ^ b1
+    hash[2] ^= s2 ^ b2
+    hash[3] ^= s3 ^ b3
+    hash[4] ^= s4 ^ b4
+    hash[5] ^= s5 ^ b5
+    hash[6] ^= s6 ^ b6
+    hash[7] ^= s7 ^ b7
 
-#
-# Tests.
-#
+_numpy_tables = []
+
+def _hash_lockstep(numpy, blocks):
+    """Hash the padded messages in the rows of a uint64 matrix, all of the
+    same length, and return their chaining values as another matrix."""
+    if not _numpy_tables:
+        _numpy_tables.extend([numpy.array(C, dtype=numpy.uint64) for C in _C])
+        _numpy_tables.append(numpy.array(_RC, dtype=numpy.uint64))
+        # Columns feeding each table: word i takes T[t] from word i - t.
+        _numpy_tables.append([[(i - t) % 8 for i in xrange(8)]
+                              for t in xrange(8)])
+    T0, T1, T2, T3, T4, T5, T6, T7, RC, P = _numpy_tables
+    s8, s16, s24, s32, s40, s48, s56 = [
+        numpy.uint64(n) for n in (8, 16, 24, 32, 40, 48, 56)]
+    ff = numpy.uint64(0xff)
+
+    def layer(x):
+        return T0[x >> s56] ^ T1[(x[:, P[1]] >> s48) & ff] ^ \
+               T2[(x[:, P[2]] >> s40) & ff] ^ T3[(x[:, P[3]] >> s32) & ff] ^ \
+               T4[(x[:, P[4]] >> s24) & ff] ^ T5[(x[:, P[5]] >> s16) & ff] ^ \
+               T6[(x[:, P[6]] >> s8) & ff] ^ T7[x[:, P[7]] & ff]
 
-assert Whirlpool('The quick brown fox jumps over the lazy dog').hexdigest() == \
-       'b97de512e91e3828b40d2b0fdce9ceb3c4a71f9bea8d88e75c4fa854df36725fd2b52eb6544edcacd6f8beddfea403cb55ae31f03ad62a5ef54e42ee82c3fb35'
-assert Whirlpool('The quick brown fox jumps over the lazy eog').hexdigest() == \
-       'c27ba124205f72e6847f3e19834f925cc666d0974167af915bb462420ed40cc50900d85a1f923219d832357750492d5c143011a76988344c2635e69d06f2d38c'
-assert Whirlpool('').hexdigest() == \
-       '19fa61d75522a4669b44e39c1d2e1726c530232130d407f89afee0964997f7a73e83be698b288febcf88e3e03c4f0757ea8964e59b63d93708b138cc42a66eb3'
+    hash = numpy.zeros((blocks.shape[0], 8), dtype=numpy.uint64)
+    for b in xrange(0, blocks.shape[1], 8):
+        block = blocks[:, b:b + 8].astype(numpy.uint64)
+        K = hash
+        state = block ^ K
+        for r in RC:
+            K = layer(K)
+            K[:, 0] ^= r
+            state = layer(state) ^ K
+        hash = hash ^ state ^ block
+    return hash
 
 class hash_class:
 
@@ -810,3 +854,31 @@ class hash_class:
 
     def hash(self, text):
         return Whirlpool(text).digest()
+
+    def new(self, text=''):
+        """Return an incremental hash object with update(), copy() and
+        digest()."""
+        return Whirlpool(text)
+
+#
+# Tests.
+#
+
+def _selftest():
+    assert Whirlpool('The quick brown fox jumps over the lazy dog').hexdigest() == \
+           'b97de512e91e3828b40d2b0fdce9ceb3c4a71f9bea8d88e75c4fa854df36725fd2b52eb6544edcacd6f8beddfea403cb55ae31f03ad62a5ef54e42ee82c3fb35'
+    assert Whirlpool('The quick brown fox jumps over the lazy eog').hexdigest() == \
+           'c27ba124205f72e6847f3e19834f925cc666d0974167af915bb462420ed40cc50900d85a1f923219d832357750492d5c143011a76988344c2635e69d06f2d38c'
+    assert Whirlpool('').hexdigest() == \
+           '19fa61d75522a4669b44e39c1d2e1726c530232130d407f89afee0964997f7a73e83be698b288febcf88e3e03c4f0757ea8964e59b63d93708b138cc42a66eb3'
+
+if __name__ == '__main__':
+    _selftest()
+    import random
+    messages = [''.join([chr(random.randint(0, 255))
+                         for i in xrange(random.randint(0, 200))])
+                for n in xrange(100)]
+    assert hash_many(messages) == [Whirlpool(m).digest() for m in messages]
+else:
+    from cryptoalgo import selftest
+    selftest.verify('WHIRLPOOL', _selftest)
@@ -0,0 +1,136 @@
+"""
+Known-Answer Self-Tests
+=======================
+Every algorithm module with test vectors defines a function `_selftest()`,
+raising AssertionError on a wrong answer, and hands it to `verify()` at the
+end of the module. The vectors of pure Python code are slow to run, so a
+passed test is remembered in a cache file, keyed by the algorithm name and a
+checksum of the module source. Later imports of the same code skip the
+vectors; a changed module is tested again.
+
+The cache is kept in the data directory, the one holding the configuration
+file found through 'confpath.dat' (see _geheimnis_), because the program
+directory may be read-only. Only without a readable configuration is it
+kept next to this module. CACHE_FILE may be set to override both.
+
+A test which passed is not run again in the same process, even when it
+cannot be cached: if the module source cannot be read, or the cache cannot
+be written. The latter is reported once per process on standard error.
+
+All registered algorithms are listed in TESTS. `run_all()`, used by the
+'selftest' command, ignores the cache and runs every test again.
+"""
+import os
+import sys
+import zlib
+
+CACHE_NAME = 'selftest.dat'
+CACHE_FILE = None
+
+# Algorithm name -> module defining _selftest().
+TESTS = {
+    'MD5': 'cryptoalgo.hash.md5',
+    'SHA': 'cryptoalgo.hash._slowsha',
+    'WHIRLPOOL': 'cryptoalgo.hash.whirlpool',
+    'RIJNDAEL': 'cryptoalgo.symmetric.rijndael',
+    'TWOFISH': 'cryptoalgo.symmetric.twofish',
+}
+
+_passed = []
+
+# (name, cache key) of the tests passed in this process.
+_passed_here = set()
+_save_failed = []
+
+def _cache_file():
+    if CACHE_FILE is not None:
+        return CACHE_FILE
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    base_dir = os.path.dirname(package_dir)
+    try:
+        f = open(os.path.join(base_dir, 'confpath.dat'), 'r')
+        ini_path = f.read().strip()
+        f.close()
+        ini_path = os.path.realpath(os.path.join(base_dir, ini_path))
+        if os.path.isfile(ini_path):
+            return os.path.join(os.path.dirname(ini_path), CACHE_NAME)
+    except IOError:
+        pass
+    return os.path.join(package_dir, CACHE_NAME)
+
+def _load_cache():
+    if not _passed:
+        _passed.append(set())
+        try:
+            f = open(_cache_file(), 'r')
+            _passed[0].update(line.strip() for line in f)
+            f.close()
+        except IOError:
+            pass
+    return _passed[0]
+
+def _save_cache(passed):
+    # Write to a temporary file and rename it, so that concurrent processes
+    # never read a half written cache.
+    cache_file = _cache_file()
+    temp = '%s.%d' % (cache_file, os.getpid())
+    try:
+        f = open(temp, 'w')
+        f.write(''.join(key + '\n' for key in sorted(passed)))
+        f.close()
+        os.rename(temp, cache_file)
+    except (IOError, OSError), e:
+        # A read-only installation runs the vectors once per process.
+        if not _save_failed:
+            _save_failed.append(cache_file)
+            sys.stderr.write(
+                'Self-test cache %s cannot be written: %s\n' % (cache_file, e)
+            )
+
+def _cache_key(name, function):
+    source = function.func_globals.get('__file__')
+    if source is None:
+        return None
+    if source[-4:] in ('.pyc', '.pyo') and os.path.isfile(source[:-1]):
+        source = source[:-1]
+    try:
+        f = open(source, 'rb')
+        checksum = zlib.crc32(f.read()) & 0xffffffff
+        f.close()
+    except IOError:
+        return None
+    return '%s:%08x' % (name, checksum)
+
+def verify(name, function, force=False):
+    """Run the self-test `function` of algorithm `name`, unless it has
+    already passed for the current module source. Raises RuntimeError if
+    the test fails."""
+    if name not in TESTS:
+        raise RuntimeError('Unregistered self-test: %s' % name)
+    key = _cache_key(name, function)
+    passed = _load_cache()
+    if (key in passed or (name, key) in _passed_here) and not force:
+        return
+    try:
+        function()
+    except AssertionError:
+        raise RuntimeError('Self-test of %s failed.' % name)
+    _passed_here.add((name, key))
+    if key is not None:
+        stale = [i for i in passed if i.split(':')[0] == name]
+        passed.difference_update(stale)
+        passed.add(key)
+        _save_cache(passed)
+
+def run_all():
+    """Run every registered self-test, ignoring the cache. Returns a list
+    of (name, error) pairs, where error is None for a passed test."""
+    results = []
+    for name in sorted(TESTS):
+        try:
+            module = __import__(TESTS[name], fromlist=['_selftest'])
+            verify(name, module._selftest, force=True)
+            results.append((name, None))
+        except Exception, e:
+            results.append((name, str(e) or e.__class__.__name__))
+    return results
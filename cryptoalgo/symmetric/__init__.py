@@ -1,7 +1,116 @@
+"""
+Symmetric Ciphers
+=================
+Every cipher is registered here by name and key size, together with its
+backends in order of preference and the block size of each; backends of
+the same cipher may differ in block size, e.g. PyCrypto only offers 16-byte
+Rijndael (AES). A cipher module is imported only when the cipher is first
+asked for, so processes never using it do not pay for loading it.
+
+    get_class('rijndael')              # class of the best available backend
+    get_class('rijndael', 'python')    # class of the given backend
+    get_backend('rijndael')            # e.g. 'pycrypto'
+    get_info('serpent')['key_size']    # 32
+    get_info('rijndael', 'python')['block_size']     # 32
+"""
+import types
+
 __all__ = [
-    'blowfish',
     'rijndael',
     'serpent',
     'twofish',
     'xxtea',
 ]
+
+# Each backend is (backend name, module, attribute, block size). The
+# attribute is either the cipher class or a function returning it, which
+# raises ImportError if the backend is not available on this system.
+CIPHERS = {
+    'rijndael': {
+        'key_size': 32,
+        'backends': [
+            ('pycrypto', 'rijndael', 'get_pycrypto_class', 16),
+            ('numpy', 'rijndael', 'get_numpy_class', 32),
+            ('python', 'rijndael', 'Rijndael', 32),
+        ],
+    },
+    'serpent': {
+        'key_size': 32,
+        'backends': [
+            ('python', 'serpent', 'Serpent', 16),
+        ],
+    },
+    'twofish': {
+        'key_size': 32,
+        'backends': [
+            ('python', 'twofish', 'Twofish', 16),
+        ],
+    },
+    'xxtea': {
+        'key_size': 16,
+        'backends': [
+            ('python', 'xxtea', 'XXTEA', 8),
+        ],
+    },
+}
+
+_loaded = {}
+
+def list_ciphers():
+    """Return the names of all registered ciphers."""
+    return sorted(CIPHERS.keys())
+
+def get_info(name, backend=None):
+    """Return key size and block size of a cipher.
+
+    The block size is that of 'backend', or without it, of the backend
+    get_class() chooses. Only the latter needs to import the cipher module,
+    if get_class() has not done so yet."""
+    if not name in CIPHERS:
+        raise RuntimeError('Unrecognized cipher.')
+    if backend == None:
+        backend = get_backend(name)
+    for backend_name, module_name, attribute, block_size in \
+            CIPHERS[name]['backends']:
+        if backend_name == backend:
+            return {
+                'key_size': CIPHERS[name]['key_size'],
+                'block_size': block_size,
+            }
+    raise RuntimeError('Unrecognized backend of cipher %s.' % name)
+
+def get_class(name, backend=None):
+    """Return the class implementing a cipher.
+
+    Without 'backend' the first available backend is chosen. The module is
+    imported on first use and the result is remembered."""
+    return _load(name, backend)[1]
+
+def get_backend(name, backend=None):
+    """Return the name of the backend get_class() chooses."""
+    return _load(name, backend)[0]
+
+def _load(name, backend):
+    if (name, backend) in _loaded:
+        return _loaded[(name, backend)]
+    if not name in CIPHERS:
+        raise RuntimeError('Unrecognized cipher.')
+
+    for backend_name, module_name, attribute, block_size in \
+            CIPHERS[name]['backends']:
+        if backend != None and backend != backend_name:
+            continue
+        module = __import__(
+            'cryptoalgo.symmetric.%s' % module_name,
+            fromlist=[attribute],
+        )
+        loader = getattr(module, attribute)
+        try:
+            if type(loader) == types.FunctionType:
+                loader = loader()
+        except ImportError:
+            continue
+        _loaded[(name, backend)] = (backend_name, loader)
+        return _loaded[(name, backend)]
+
+    raise RuntimeError('No backend available for cipher %s.' % name)
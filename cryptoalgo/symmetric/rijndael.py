@@ -57,6 +57,8 @@ block_size = BLOCK_SIZE
 key_size = 32
 
 class Rijndael:
+
+    backend = 'python'
     
     def __init__(self, key=None):
         self.ctx = RijndaelCTX()
@@ -250,7 +252,7 @@ gentables()
 
 
 #def setkey(rinst, key, nk):
-def setkey(rinst, key):
+def setkey(rinst, key, block_size=BLOCK_SIZE):
     key = [ord(k) for k in key]
     keylen = len(key)
     assert keylen in [32, 24, 16]
@@ -258,15 +260,15 @@ def setkey(rinst, key):
     nk = keylen
     #nb = 8
     nb = 0
-    if BLOCK_SIZE == 16:
+    if block_size == 16:
         nb = 4
-    elif BLOCK_SIZE == 24:
+    elif block_size == 24:
         nb = 6
-    elif BLOCK_SIZE == 32:
+    elif block_size == 32:
         nb = 8
     CipherKey = [0]*8
     nk /= 4
-    if BLOCK_SIZE == 16 and nk < 4:
+    if block_size == 16 and nk < 4:
         nk = 4
     rinst.Nb = nb
     rinst.Nk = nk
@@ -402,38 +404,176 @@ def decrypt(rinst, buff):
         j += 4
     return ''.join([chr(b) for b in buff])
     
+#
+# NumPy engine.
+#
+
+class RijndaelNumPy:
+    """Rijndael running all blocks of one call in parallel.
+
+    Every round is expressed as gathered lookups into the same tables the
+    pure Python code uses, applied to a (blocks x Nb) word matrix. Output
+    equals class Rijndael with the same block size; 16 (AES), 24 and 32
+    byte blocks are supported, defaulting to BLOCK_SIZE like class Rijndael."""
+
+    backend = 'numpy'
+
+    def __init__(self, key=None, block_size=BLOCK_SIZE):
+        if block_size not in [16, 24, 32]:
+            raise ValueError, "block size must be 16, 24 or 32"
+        self.block_size = block_size
+        if key:
+            self.set_key(key)
+
+    def set_key(self, key):
+        numpy = _numpy_tables()['numpy']
+        rinst = RijndaelCTX()
+        setkey(rinst, key, self.block_size)
+        nb, nr = rinst.Nb, rinst.Nr
+        words = nb * (nr + 1)
+        self.nr = nr
+        self.fkey = numpy.array(rinst.fkey[:words], dtype=numpy.uint32)\
+            .reshape(nr + 1, nb)
+        self.rkey = numpy.array(rinst.rkey[:words], dtype=numpy.uint32)\
+            .reshape(nr + 1, nb)
+        self.fshift = [rinst.fi[i:3 * nb:3] for i in xrange(3)]
+        self.rshift = [rinst.ri[i:3 * nb:3] for i in xrange(3)]
+
+    def encrypt(self, data):
+        tables = _numpy_tables()
+        return self._crypt(data, self.fkey, self.fshift,
+                           tables['ftable'], tables['fbsub'])
+
+    def decrypt(self, data):
+        tables = _numpy_tables()
+        return self._crypt(data, self.rkey, self.rshift,
+                           tables['rtable'], tables['rbsub'])
+
+    def _crypt(self, data, rkey, shift, table, sbox):
+        if len(data) % self.block_size:
+            raise ValueError, "data must be multiple of %d" % self.block_size
+        if not data:
+            return ''
+        numpy = _numpy_tables()['numpy']
+        s1, s2, s3 = shift
+        T0, T1, T2, T3 = table
+        x = numpy.frombuffer(data, dtype='<u4')\
+            .reshape(-1, self.block_size / 4) ^ rkey[0]
+        for r in xrange(1, self.nr):
+            x = rkey[r] ^ T0[x & 0xff] ^ \
+                T1[(x[:, s1] >> 8) & 0xff] ^ \
+                T2[(x[:, s2] >> 16) & 0xff] ^ \
+                T3[x[:, s3] >> 24]
+        T0, T1, T2, T3 = sbox
+        x = rkey[self.nr] ^ T0[x & 0xff] ^ \
+            T1[(x[:, s1] >> 8) & 0xff] ^ \
+            T2[(x[:, s2] >> 16) & 0xff] ^ \
+            T3[x[:, s3] >> 24]
+        return x.astype('<u4').tostring()
+
+    def get_name(self):
+        if self.block_size == 16:
+            return "Rijndael"
+        return "Rijndael-%d" % (self.block_size * 8)
+
+    def get_key_size(self):
+        return 32
+
+    def get_block_size(self):
+        return self.block_size
+
+_numpy_cache = {}
+
+def _numpy_tables():
+    """Import NumPy and build the rotated lookup tables on first use, so
+    that importing this module stays as cheap as before."""
+    if not _numpy_cache:
+        import numpy
+        def rotations(table):
+            t = numpy.array(table, dtype=numpy.uint32)
+            return (t, (t << 8) | (t >> 24), (t << 16) | (t >> 16),
+                    (t << 24) | (t >> 8))
+        _numpy_cache['ftable'] = rotations(ftable)
+        _numpy_cache['rtable'] = rotations(rtable)
+        _numpy_cache['fbsub'] = rotations(fbsub)
+        _numpy_cache['rbsub'] = rotations(rbsub)
+        _numpy_cache['numpy'] = numpy
+    return _numpy_cache
+
 #
 # Tests.
 #
 
+def get_pycrypto_class():
+    """Return a Rijndael class backed by PyCrypto's AES. Raises ImportError
+    if PyCrypto is not installed."""
+    import Crypto.Cipher.AES
+    class Rijndael_Alternative:
+        backend = 'pycrypto'
+        def __init__(self, key=None):
+            if key:
+                self.aes = Crypto.Cipher.AES.new(key)
+        def set_key(self, key):
+            self.aes = Crypto.Cipher.AES.new(key)
+        def decrypt(self, data):
+            return self.aes.decrypt(data)
+        def encrypt(self, data):
+            return self.aes.encrypt(data)
+        def get_name(self):
+            return "Rijndael"
+        def get_key_size(self):
+            return 32
+        def get_block_size(self):
+            return 16
+    return Rijndael_Alternative
+
+def get_numpy_class():
+    """Return RijndaelNumPy. Raises ImportError if NumPy is not installed."""
+    import numpy
+    return RijndaelNumPy
+
 def get_class(purePython=False):
+    """Return the fastest available Rijndael class.
+
+    PyCrypto's AES comes first, then the NumPy engine, then the pure Python
+    code. Use get_backend() to find out which one was chosen."""
+    if not purePython:
+        for loader in [get_pycrypto_class, get_numpy_class]:
+            try:
+                return loader()
+            except ImportError:
+                pass
+    return Rijndael
+
+def get_backend(purePython=False):
+    """Return the name of the backend get_class() picks: 'pycrypto',
+    'numpy' or 'python'."""
+    return get_class(purePython).backend
+
+
+def _selftest():
+    if BLOCK_SIZE == 32:
+        assert Rijndael('\x10'*32).encrypt('1234'*8) == '<\xd94\x07P\x17\x0eC\xa6\xe0\xf0)\x80\x82\xdc\x94y\x02MYC]J\xe6\\\xd8n\x15P#\x10\x02'
+        assert Rijndael('\x10'*32).decrypt('<\xd94\x07P\x17\x0eC\xa6\xe0\xf0)\x80\x82\xdc\x94y\x02MYC]J\xe6\\\xd8n\x15P#\x10\x02') == '1234'*8
+    elif BLOCK_SIZE == 16:
+        assert Rijndael('012345678abcdefgh00112233xyzqwer').encrypt('a'*16) == '%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96'
+        assert Rijndael('012345678abcdefgh00112233xyzqwer').decrypt('%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96') == 'a'*16
+        assert Rijndael('\x10'*32).encrypt('1234'*4) == '\xba\xad\xaawV|S\xc36>1\x03\xfd\x9e+\x9d'
     try:
-        if purePython:
-            raise Exception()
-        import Crypto.Cipher.AES
-        class Rijndael_Alternative:
-            def __init__(self, key=None):
-                if key:
-                    self.aes = Crypto.Cipher.AES.new(key)
-            def set_key(self, key):
-                self.aes = Crypto.Cipher.AES.new(key)
-            def decrypt(self, data):
-                return self.aes.decrypt(data)
-            def encrypt(self, data):
-                return self.aes.encrypt(data)
-            def get_name(self):
-                return "Rijndael"
-            def get_key_size(self):
-                return 32
-            def get_block_size(self):
-                return 16
-        return Rijndael_Alternative
-    except:
-        return Rijndael
-
-
-if __name__ == "__main__" and BLOCK_SIZE == 16:
-    cipher = get_class()
-    assert Rijndael('012345678abcdefgh00112233xyzqwer').encrypt('a'*16) == '%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96'
-    assert Rijndael('012345678abcdefgh00112233xyzqwer').decrypt('%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96') == 'a'*16
-    assert Rijndael('\x10'*32).encrypt('1234'*4) == '\xba\xad\xaawV|S\xc36>1\x03\xfd\x9e+\x9d'
+        get_numpy_class()
+    except ImportError:
+        return
+    aes = RijndaelNumPy('012345678abcdefgh00112233xyzqwer', 16)
+    assert aes.encrypt('a'*16) == '%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96'
+    assert aes.decrypt('%\x98\x8a \xf8\\\x10\x9c\x17\x16\x9bb\x9e\xd6*\x96') == 'a'*16
+    assert RijndaelNumPy('\x10'*32, 16).encrypt('1234'*4) == '\xba\xad\xaawV|S\xc36>1\x03\xfd\x9e+\x9d'
+    data = ''.join(chr(i % 251) for i in xrange(BLOCK_SIZE * 9))
+    assert RijndaelNumPy('\x10'*32).encrypt(data) == Rijndael('\x10'*32).encrypt(data)
+    assert RijndaelNumPy('\x10'*32).decrypt(data) == Rijndael('\x10'*32).decrypt(data)
+
+if __name__ == "__main__":
+    _selftest()
+    print "Backend: %s" % get_backend()
+else:
+    from cryptoalgo import selftest
+    selftest.verify('RIJNDAEL', _selftest)
@@ -69,11 +69,7 @@ class Twofish:
         self.context = TWI()
         
         key_word32 = [0] * 32
-        i = 0
-        while key:
-            key_word32[i] = struct.unpack("<L", key[0:4])[0]
-            key = key[4:]
-            i += 1
+        key_word32[:key_len / 4] = struct.unpack("<%dL" % (key_len / 4), key)
 
         set_key(self.context, key_word32, key_len)
 
@@ -84,16 +80,9 @@ class Twofish:
         if len(block) % 16:
             raise ValueError, "block size must be a multiple of 16"
 
-        plaintext = ''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[:16])
-            temp = [a, b, c, d]
-            decrypt(self.context, temp)
-            plaintext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return plaintext
+        words = list(struct.unpack("<%dL" % (len(block) / 4), block))
+        decrypt(self.context, words)
+        return struct.pack("<%dL" % len(words), *words)
 
         
     def encrypt(self, block):
@@ -102,16 +91,9 @@ class Twofish:
         if len(block) % 16:
             raise ValueError, "block size must be a multiple of 16"
 
-        ciphertext = ''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[0:16])
-            temp = [a, b, c, d]
-            encrypt(self.context, temp)
-            ciphertext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return ciphertext
+        words = list(struct.unpack("<%dL" % (len(block) / 4), block))
+        encrypt(self.context, words)
+        return struct.pack("<%dL" % len(words), *words)
 
 
     def get_name(self):
@@ -276,15 +258,22 @@ def mds_rem(p0, p1):
         p1 ^= ((u << 24) & 0xffffffff) | ((u << 8) & 0xffffffff)
     return p1
 
-def set_key(pkey, in_key, key_len):
-    pkey.qt_gen = 0
-    if not pkey.qt_gen:
+_fixed_tables = []
+
+def fixed_tables():
+    """Return (q_tab, m_tab). They do not depend on the key, so they are
+    generated once and shared by all contexts."""
+    if not _fixed_tables:
+        pkey = TWI()
         gen_qtab(pkey)
-        pkey.qt_gen = 1
-    pkey.mt_gen = 0
-    if not pkey.mt_gen:
         gen_mtab(pkey)
-        pkey.mt_gen = 1
+        _fixed_tables.extend([pkey.q_tab, pkey.m_tab])
+    return _fixed_tables
+
+def set_key(pkey, in_key, key_len):
+    pkey.q_tab, pkey.m_tab = fixed_tables()
+    pkey.qt_gen = 1
+    pkey.mt_gen = 1
     pkey.k_len = (key_len * 8) / 64
 
     a = 0
@@ -312,85 +301,92 @@ def set_key(pkey, in_key, key_len):
     gen_mk_tab(pkey, pkey.s_key)
 
 def encrypt(pkey, in_blk):
-    blk = [0, 0, 0, 0]
+    """Encrypt in place a list of words holding one or more blocks.
+
+    Whole blocks run inside one call, with the key-dependent S-box/MDS
+    tables (mk_tab, full keying) and the subkeys bound to locals."""
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
 
     if WORD_BIGENDIAN:
-	blk[0] = byteswap32(in_blk[0]) ^ pkey.l_key[0];
-	blk[1] = byteswap32(in_blk[1]) ^ pkey.l_key[1];
-	blk[2] = byteswap32(in_blk[2]) ^ pkey.l_key[2];
-	blk[3] = byteswap32(in_blk[3]) ^ pkey.l_key[3];
-    else:
-	blk[0] = in_blk[0] ^ pkey.l_key[0];
-	blk[1] = in_blk[1] ^ pkey.l_key[1];
-	blk[2] = in_blk[2] ^ pkey.l_key[2];
-	blk[3] = in_blk[3] ^ pkey.l_key[3];        
+        in_blk[:] = [byteswap32(w) for w in in_blk]
 
-    for i in xrange(8):
-        t1 = ( pkey.mk_tab[0][byte(blk[1],3)] ^ pkey.mk_tab[1][byte(blk[1],0)] ^ pkey.mk_tab[2][byte(blk[1],1)] ^ pkey.mk_tab[3][byte(blk[1],2)] ); 
-        t0 = ( pkey.mk_tab[0][byte(blk[0],0)] ^ pkey.mk_tab[1][byte(blk[0],1)] ^ pkey.mk_tab[2][byte(blk[0],2)] ^ pkey.mk_tab[3][byte(blk[0],3)] );
-        
-        blk[2] = rotr32(blk[2] ^ ((t0 + t1 + pkey.l_key[4 * (i) + 8]) % 0x100000000), 1);
-        blk[3] = rotl32(blk[3], 1) ^ ((t0 + 2 * t1 + pkey.l_key[4 * (i) + 9]) % 0x100000000);
+    for n in xrange(0, len(in_blk), 4):
+        b0 = in_blk[n] ^ k[0]
+        b1 = in_blk[n + 1] ^ k[1]
+        b2 = in_blk[n + 2] ^ k[2]
+        b3 = in_blk[n + 3] ^ k[3]
 
-        t1 = ( pkey.mk_tab[0][byte(blk[3],3)] ^ pkey.mk_tab[1][byte(blk[3],0)] ^ pkey.mk_tab[2][byte(blk[3],1)] ^ pkey.mk_tab[3][byte(blk[3],2)] ); 
-        t0 = ( pkey.mk_tab[0][byte(blk[2],0)] ^ pkey.mk_tab[1][byte(blk[2],1)] ^ pkey.mk_tab[2][byte(blk[2],2)] ^ pkey.mk_tab[3][byte(blk[2],3)] );
-        
-        blk[0] = rotr32(blk[0] ^ ((t0 + t1 + pkey.l_key[4 * (i) + 10]) % 0x100000000), 1);
-        blk[1] = rotl32(blk[1], 1) ^ ((t0 + 2 * t1 + pkey.l_key[4 * (i) + 11]) % 0x100000000);         
+        for i in xrange(8, 40, 4):
+            t1 = m0[b1 >> 24] ^ m1[b1 & 0xff] ^ m2[(b1 >> 8) & 0xff] ^ m3[(b1 >> 16) & 0xff]
+            t0 = m0[b0 & 0xff] ^ m1[(b0 >> 8) & 0xff] ^ m2[(b0 >> 16) & 0xff] ^ m3[b0 >> 24]
+
+            b2 ^= (t0 + t1 + k[i]) & 0xffffffff
+            b2 = (b2 >> 1) | ((b2 << 31) & 0xffffffff)
+            b3 = ((b3 << 1) & 0xffffffff | (b3 >> 31)) ^ ((t0 + 2 * t1 + k[i + 1]) & 0xffffffff)
+
+            t1 = m0[b3 >> 24] ^ m1[b3 & 0xff] ^ m2[(b3 >> 8) & 0xff] ^ m3[(b3 >> 16) & 0xff]
+            t0 = m0[b2 & 0xff] ^ m1[(b2 >> 8) & 0xff] ^ m2[(b2 >> 16) & 0xff] ^ m3[b2 >> 24]
+
+            b0 ^= (t0 + t1 + k[i + 2]) & 0xffffffff
+            b0 = (b0 >> 1) | ((b0 << 31) & 0xffffffff)
+            b1 = ((b1 << 1) & 0xffffffff | (b1 >> 31)) ^ ((t0 + 2 * t1 + k[i + 3]) & 0xffffffff)
+
+        in_blk[n] = b2 ^ k[4]
+        in_blk[n + 1] = b3 ^ k[5]
+        in_blk[n + 2] = b0 ^ k[6]
+        in_blk[n + 3] = b1 ^ k[7]
 
     if WORD_BIGENDIAN:
-	in_blk[0] = byteswap32(blk[2] ^ pkey.l_key[4]);
-	in_blk[1] = byteswap32(blk[3] ^ pkey.l_key[5]);
-	in_blk[2] = byteswap32(blk[0] ^ pkey.l_key[6]);
-	in_blk[3] = byteswap32(blk[1] ^ pkey.l_key[7]);
-    else:
-        in_blk[0] = blk[2] ^ pkey.l_key[4];
-        in_blk[1] = blk[3] ^ pkey.l_key[5];
-        in_blk[2] = blk[0] ^ pkey.l_key[6];
-        in_blk[3] = blk[1] ^ pkey.l_key[7];
-        
+        in_blk[:] = [byteswap32(w) for w in in_blk]
     return
 
 def decrypt(pkey, in_blk):
-    blk = [0, 0, 0, 0]
-    
+    """Decrypt in place a list of words holding one or more blocks."""
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
+
     if WORD_BIGENDIAN:
-	blk[0] = byteswap32(in_blk[0]) ^ pkey.l_key[4];
-	blk[1] = byteswap32(in_blk[1]) ^ pkey.l_key[5];
-	blk[2] = byteswap32(in_blk[2]) ^ pkey.l_key[6];
-	blk[3] = byteswap32(in_blk[3]) ^ pkey.l_key[7];
-    else:
-	blk[0] = in_blk[0] ^ pkey.l_key[4];
-	blk[1] = in_blk[1] ^ pkey.l_key[5];
-	blk[2] = in_blk[2] ^ pkey.l_key[6];
-	blk[3] = in_blk[3] ^ pkey.l_key[7];    
+        in_blk[:] = [byteswap32(w) for w in in_blk]
+
+    for n in xrange(0, len(in_blk), 4):
+        b0 = in_blk[n] ^ k[4]
+        b1 = in_blk[n + 1] ^ k[5]
+        b2 = in_blk[n + 2] ^ k[6]
+        b3 = in_blk[n + 3] ^ k[7]
+
+        for i in xrange(36, 4, -4):
+            t1 = m0[b1 >> 24] ^ m1[b1 & 0xff] ^ m2[(b1 >> 8) & 0xff] ^ m3[(b1 >> 16) & 0xff]
+            t0 = m0[b0 & 0xff] ^ m1[(b0 >> 8) & 0xff] ^ m2[(b0 >> 16) & 0xff] ^ m3[b0 >> 24]
 
-    for i in xrange(7, -1, -1):
-        t1 = ( pkey.mk_tab[0][byte(blk[1],3)] ^ pkey.mk_tab[1][byte(blk[1],0)] ^ pkey.mk_tab[2][byte(blk[1],1)] ^ pkey.mk_tab[3][byte(blk[1],2)] )
-        t0 = ( pkey.mk_tab[0][byte(blk[0],0)] ^ pkey.mk_tab[1][byte(blk[0],1)] ^ pkey.mk_tab[2][byte(blk[0],2)] ^ pkey.mk_tab[3][byte(blk[0],3)] )
+            b2 = ((b2 << 1) & 0xffffffff | (b2 >> 31)) ^ ((t0 + t1 + k[i + 2]) & 0xffffffff)
+            b3 ^= (t0 + 2 * t1 + k[i + 3]) & 0xffffffff
+            b3 = (b3 >> 1) | ((b3 << 31) & 0xffffffff)
 
-        blk[2] = rotl32(blk[2], 1) ^ ((t0 + t1 + pkey.l_key[4 * (i) + 10]) % 0x100000000)
-        blk[3] = rotr32(blk[3] ^ ((t0 + 2 * t1 + pkey.l_key[4 * (i) + 11]) % 0x100000000), 1)
+            t1 = m0[b3 >> 24] ^ m1[b3 & 0xff] ^ m2[(b3 >> 8) & 0xff] ^ m3[(b3 >> 16) & 0xff]
+            t0 = m0[b2 & 0xff] ^ m1[(b2 >> 8) & 0xff] ^ m2[(b2 >> 16) & 0xff] ^ m3[b2 >> 24]
 
-        t1 = ( pkey.mk_tab[0][byte(blk[3],3)] ^ pkey.mk_tab[1][byte(blk[3],0)] ^ pkey.mk_tab[2][byte(blk[3],1)] ^ pkey.mk_tab[3][byte(blk[3],2)] )
-        t0 = ( pkey.mk_tab[0][byte(blk[2],0)] ^ pkey.mk_tab[1][byte(blk[2],1)] ^ pkey.mk_tab[2][byte(blk[2],2)] ^ pkey.mk_tab[3][byte(blk[2],3)] )
+            b0 = ((b0 << 1) & 0xffffffff | (b0 >> 31)) ^ ((t0 + t1 + k[i]) & 0xffffffff)
+            b1 ^= (t0 + 2 * t1 + k[i + 1]) & 0xffffffff
+            b1 = (b1 >> 1) | ((b1 << 31) & 0xffffffff)
 
-        blk[0] = rotl32(blk[0], 1) ^ ((t0 + t1 + pkey.l_key[4 * (i) + 8]) % 0x100000000)
-        blk[1] = rotr32(blk[1] ^ ((t0 + 2 * t1 + pkey.l_key[4 * (i) + 9]) % 0x100000000), 1)        
+        in_blk[n] = b2 ^ k[0]
+        in_blk[n + 1] = b3 ^ k[1]
+        in_blk[n + 2] = b0 ^ k[2]
+        in_blk[n + 3] = b1 ^ k[3]
 
     if WORD_BIGENDIAN:
-	in_blk[0] = byteswap32(blk[2] ^ pkey.l_key[0]);
-	in_blk[1] = byteswap32(blk[3] ^ pkey.l_key[1]);
-	in_blk[2] = byteswap32(blk[0] ^ pkey.l_key[2]);
-	in_blk[3] = byteswap32(blk[1] ^ pkey.l_key[3]);
-    else:
-	in_blk[0] = blk[2] ^ pkey.l_key[0];
-	in_blk[1] = blk[3] ^ pkey.l_key[1];
-	in_blk[2] = blk[0] ^ pkey.l_key[2];
-	in_blk[3] = blk[1] ^ pkey.l_key[3];
+        in_blk[:] = [byteswap32(w) for w in in_blk]
     return
 
-__testkey = '\xD4\x3B\xB7\x55\x6E\xA3\x2E\x46\xF2\xA2\x82\xB7\xD4\x5B\x4E\x0D\x57\xFF\x73\x9D\x4D\xC9\x2C\x1B\xD7\xFC\x01\x70\x0C\xC8\x21\x6F'
-__testdat = '\x90\xAF\xE9\x1B\xB2\x88\x54\x4F\x2C\x32\xDC\x23\x9B\x26\x35\xE6'
-assert 'l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa' == Twofish(__testkey).encrypt(__testdat)
-assert __testdat == Twofish(__testkey).decrypt('l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa')
+def _selftest():
+    testkey = '\xD4\x3B\xB7\x55\x6E\xA3\x2E\x46\xF2\xA2\x82\xB7\xD4\x5B\x4E\x0D\x57\xFF\x73\x9D\x4D\xC9\x2C\x1B\xD7\xFC\x01\x70\x0C\xC8\x21\x6F'
+    testdat = '\x90\xAF\xE9\x1B\xB2\x88\x54\x4F\x2C\x32\xDC\x23\x9B\x26\x35\xE6'
+    assert 'l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa' == Twofish(testkey).encrypt(testdat)
+    assert testdat == Twofish(testkey).decrypt('l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa')
+
+if __name__ == '__main__':
+    _selftest()
+else:
+    from cryptoalgo import selftest
+    selftest.verify('TWOFISH', _selftest)
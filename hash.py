@@ -26,7 +26,111 @@ Output
 ------
 The output is simply a hash. Depending on your options, it can be Base64, HEX,
 or raw.
+
+Files
+-----
+Instead of 'text', the arguments may give 'file', the path of a file to be
+hashed. It is read in chunks (through mmap where possible), so files of any
+size are hashed in constant memory. The throughput is reported on stderr.
+
+Several Algorithms
+------------------
+With 'algorithms' set in the arguments to a list of algorithm names, the
+text or file is read once and hashed with all of them. The output is a JSON
+object {algorithm: digest}; option 'algorithm' is ignored.
+
+Tree Hashing
+------------
+With 'tree' set in the arguments, a text or file is hashed as a Merkle tree
+(see tree_hasher) whose leaves are hashed in parallel. 'tree' is the leaf
+size in bytes, or True for the default size. HMAC is not available in this
+mode. This is a different digest from the normal one.
+
+Stream Mode
+-----------
+Started as 'python hash.py stream', the program serves any number of
+requests in one process. Each request on stdin is a 4-byte big-endian length
+followed by that many bytes of Msgpack-ed {'options': ..., 'text': ...}, the
+same dict as in normal mode. For each request, in order, a response is
+written to stdout the same way: a 4-byte length and a Msgpack-ed
+{'digest': ...}, {'digests': ...} for several algorithms, or {'error': ...}
+if this request could not be served. The program ends at the end of stdin.
+
+Self-Test
+---------
+'python hash.py selftest' checks that merkle_hasher, after random changes,
+gives the same digests as hashing everything again.
 """
+import collections
+import mmap
+import os
+import struct
+import time
+
+# Registry of all hash algorithms in cryptoalgo.hash, built on first use:
+# {name: (block size in bits, hash_class instance)}. It is shared by all
+# hash generators and not changed after being built.
+_algorithms = []
+
+def _get_algorithms():
+    if not _algorithms:
+        hash_module = __import__('cryptoalgo.hash', fromlist='*')
+        algorithms = {}
+        for each in hash_module.__all__:
+            new_hash_class = getattr(hash_module, each).hash_class()
+            algorithms[new_hash_class.get_name()] = (
+                new_hash_class.get_block_size(),
+                new_hash_class,
+            )
+        _algorithms.append(algorithms)
+    return _algorithms[0]
+
+def _format_output(binary_digest, output_format):
+    output_format = output_format.upper()
+    if output_format == 'HEX': return binary_digest.encode('hex')
+    if output_format == 'BASE64': return binary_digest.encode('base64')
+    return binary_digest
+
+class hash_context:
+    """An incremental hash or HMAC, as returned by hash_generator.new().
+
+    Works like the objects from hashlib: update() feeds more text, copy()
+    clones the state, digest() and hexdigest() return the hash or HMAC of
+    all text so far without ending the computation. result() returns it in
+    the output format of the generator which made this context."""
+
+    def __init__(self, name, inner, outer, output_format):
+        # For HMAC 'outer' is a hash object already fed with the outer
+        # padded key, and is never changed. Otherwise it is None.
+        self.name = name
+        self._inner = inner
+        self._outer = outer
+        self._output_format = output_format
+
+    def update(self, text):
+        self._inner.update(text)
+
+    def copy(self):
+        return hash_context(
+            self.name,
+            self._inner.copy(),
+            self._outer,
+            self._output_format
+        )
+
+    def digest(self):
+        raw_digest = self._inner.digest()
+        if self._outer != None:
+            outer = self._outer.copy()
+            outer.update(raw_digest)
+            raw_digest = outer.digest()
+        return raw_digest
+
+    def hexdigest(self):
+        return self.digest().encode('hex')
+
+    def result(self):
+        return _format_output(self.digest(), self._output_format)
 
 class hash_generator:
 
@@ -34,46 +138,32 @@ class hash_generator:
     __trans_5C = """\\]^_XYZ[TUVWPQRSLMNOHIJKDEFG@ABC|}~\x7fxyz{tuvwpqrslmnohijkdefg`abc\x1c\x1d\x1e\x1f\x18\x19\x1a\x1b\x14\x15\x16\x17\x10\x11\x12\x13\x0c\r\x0e\x0f\x08\t\n\x0b\x04\x05\x06\x07\x00\x01\x02\x03<=>?89:;45670123,-./()*+$%&\' !"#\xdc\xdd\xde\xdf\xd8\xd9\xda\xdb\xd4\xd5\xd6\xd7\xd0\xd1\xd2\xd3\xcc\xcd\xce\xcf\xc8\xc9\xca\xcb\xc4\xc5\xc6\xc7\xc0\xc1\xc2\xc3\xfc\xfd\xfe\xff\xf8\xf9\xfa\xfb\xf4\xf5\xf6\xf7\xf0\xf1\xf2\xf3\xec\xed\xee\xef\xe8\xe9\xea\xeb\xe4\xe5\xe6\xe7\xe0\xe1\xe2\xe3\x9c\x9d\x9e\x9f\x98\x99\x9a\x9b\x94\x95\x96\x97\x90\x91\x92\x93\x8c\x8d\x8e\x8f\x88\x89\x8a\x8b\x84\x85\x86\x87\x80\x81\x82\x83\xbc\xbd\xbe\xbf\xb8\xb9\xba\xbb\xb4\xb5\xb6\xb7\xb0\xb1\xb2\xb3\xac\xad\xae\xaf\xa8\xa9\xaa\xab\xa4\xa5\xa6\xa7\xa0\xa1\xa2\xa3"""
     __trans_36 = """67452301>?<=:;89&\'$%"# !./,-*+()\x16\x17\x14\x15\x12\x13\x10\x11\x1e\x1f\x1c\x1d\x1a\x1b\x18\x19\x06\x07\x04\x05\x02\x03\x00\x01\x0e\x0f\x0c\r\n\x0b\x08\tvwturspq~\x7f|}z{xyfgdebc`anolmjkhiVWTURSPQ^_\\]Z[XYFGDEBC@ANOLMJKHI\xb6\xb7\xb4\xb5\xb2\xb3\xb0\xb1\xbe\xbf\xbc\xbd\xba\xbb\xb8\xb9\xa6\xa7\xa4\xa5\xa2\xa3\xa0\xa1\xae\xaf\xac\xad\xaa\xab\xa8\xa9\x96\x97\x94\x95\x92\x93\x90\x91\x9e\x9f\x9c\x9d\x9a\x9b\x98\x99\x86\x87\x84\x85\x82\x83\x80\x81\x8e\x8f\x8c\x8d\x8a\x8b\x88\x89\xf6\xf7\xf4\xf5\xf2\xf3\xf0\xf1\xfe\xff\xfc\xfd\xfa\xfb\xf8\xf9\xe6\xe7\xe4\xe5\xe2\xe3\xe0\xe1\xee\xef\xec\xed\xea\xeb\xe8\xe9\xd6\xd7\xd4\xd5\xd2\xd3\xd0\xd1\xde\xdf\xdc\xdd\xda\xdb\xd8\xd9\xc6\xc7\xc4\xc5\xc2\xc3\xc0\xc1\xce\xcf\xcc\xcd\xca\xcb\xc8\xc9"""
 
+    # Default options. They are shared by all instances and never modified:
+    # option() gives an instance its own copy before changing anything.
     _options = {
         'algorithm': 'MD5',
         'output_format': 'HEX',
         'HMAC': False,
     }
 
-    _algorithms = {}
-
-    _hash_module = None
-
     _choosen_algorithm = None
 
-    _hmac_package = []
+    _hmac_package = False
 
     def __init__(self):
-
-        # Load hash functions
-        self._hash_module = __import__('cryptoalgo.hash', fromlist='*')
-        for each in self._hash_module.__all__:
-            new_hash_class = getattr(self._hash_module, each).hash_class()
-            self._algorithms[new_hash_class.get_name()] = [
-                new_hash_class.get_block_size(),
-                new_hash_class,
-            ]
-
         self._update()
 
     def _output(self, binary_digest):
-        output_format = self._options['output_format'].upper()
-        if output_format == 'HEX': return binary_digest.encode('hex')
-        if output_format == 'BASE64': return binary_digest.encode('base64')
-        return binary_digest
+        return _format_output(binary_digest, self._options['output_format'])
 
     def _update(self):
         """Update the hash generator within this class by options."""
 
         # Choose the algorithm
-        if not self._options['algorithm'] in self._algorithms.keys():
+        algorithms = _get_algorithms()
+        if not self._options['algorithm'] in algorithms:
             raise RuntimeError('Unrecognized hash method.')
-        choice = self._algorithms[self._options['algorithm']]
+        choice = algorithms[self._options['algorithm']]
         self._choosen_algorithm = choice[1]
         blocksize = choice[0] / 8
 
@@ -86,7 +176,12 @@ class hash_generator:
                 hmac_key += chr(0) * (blocksize - len(hmac_key))
             o_key_pad = hmac_key.translate(self.__trans_5C)
             i_key_pad = hmac_key.translate(self.__trans_36)
-            self._hmac_package = (o_key_pad, i_key_pad)
+            # Compress the padded keys once; every message then starts
+            # from copies of these states.
+            self._hmac_package = (
+                self._choosen_algorithm.new(o_key_pad),
+                self._choosen_algorithm.new(i_key_pad),
+            )
         else:
             self._hmac_package = False                
 
@@ -106,23 +201,65 @@ class hash_generator:
           })                   # Batch set a number of options.
         """
         if len(argv) == 0:
-            return self._options
+            return dict(self._options)
         else:
             leading_arg = argv[0]
             following_arg = argv[1:]
             if type(leading_arg) == dict:
-                for each in leading_arg:
-                    self.option(each, leading_arg[each])
-                return self
-            elif not leading_arg in self._options.keys():
+                new_options = leading_arg
+            elif not leading_arg in self._options:
                 raise RuntimeError('Unrecognized option name.')
+            elif len(following_arg) == 0:
+                return self._options[leading_arg]
+            else:
+                new_options = {leading_arg: following_arg[0]}
 
-        if len(following_arg) == 0:
-            return self._options[leading_arg]
+        for each in new_options:
+            if not each in self._options:
+                raise RuntimeError('Unrecognized option name.')
+        options = dict(self._options)
+        options.update(new_options)
+        self._options = options
+        self._update()
+        return self
+
+    def new(self, text=''):
+        """Return a hash_context computing the hash or HMAC of text fed in
+        pieces, with the current options. This needs constant memory,
+        however long the text is."""
+        if self._hmac_package == False:
+            context = hash_context(
+                self._options['algorithm'],
+                self._choosen_algorithm.new(),
+                None,
+                self._options['output_format']
+            )
         else:
-            self._options[leading_arg] = following_arg[0]
-            self._update()
-            return self
+            context = hash_context(
+                self._options['algorithm'],
+                self._hmac_package[1].copy(),
+                self._hmac_package[0],
+                self._options['output_format']
+            )
+        if text:
+            context.update(text)
+        return context
+
+    def digest_file(self, path, stats=None):
+        """Generate a hash or HMAC of the file at 'path', read in chunks.
+
+        If a dict is given as 'stats', 'bytes' and 'seconds' are set in it
+        to the length of the file and the time hashing it took."""
+        start = time.time()
+        context = self.new()
+        length = 0
+        for chunk in _file_chunks(path):
+            context.update(chunk)
+            length += len(chunk)
+        if stats != None:
+            stats['bytes'] = length
+            stats['seconds'] = time.time() - start
+        return context.result()
 
     def digest(self, text):
         """Generate a hash or HMAC, depending on option 'HMAC' set or not."""
@@ -131,49 +268,919 @@ class hash_generator:
             raw_digest = self._choosen_algorithm.hash(text)
         else:
             # Generate a HMAC
-            raw_digest = self._choosen_algorithm.hash(
-                self._hmac_package[0] +
-                self._choosen_algorithm.hash(
-                    self._hmac_package[1] +
-                    text
-                )
-            )
+            inner = self._hmac_package[1].copy()
+            inner.update(text)
+            outer = self._hmac_package[0].copy()
+            outer.update(inner.digest())
+            raw_digest = outer.digest()
         return self._output(raw_digest)
 
+# Files are hashed in chunks of this many bytes.
+FILE_CHUNK_SIZE = 1024 * 1024
+
+def _file_chunks(path, chunk_size=FILE_CHUNK_SIZE):
+    """Yield the content of the file at 'path' in chunks. The file is mapped
+    into memory if possible, and read otherwise (e.g. empty files, pipes)."""
+    f = open(path, 'rb')
+    try:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError, OverflowError):
+            mapped = None
+        if mapped != None:
+            try:
+                for position in xrange(0, len(mapped), chunk_size):
+                    yield mapped[position:position + chunk_size]
+            finally:
+                mapped.close()
+        else:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        f.close()
+
+def multi_digest(data_or_stream, algorithms, options=None):
+    """Compute the digests of one text under several algorithms in a single
+    pass. 'data_or_stream' is a str or a file-like object, read in chunks
+    of FILE_CHUNK_SIZE. 'options' are hash_generator options (e.g. 'HMAC',
+    'output_format') applied to every algorithm. Returns a dict
+    {algorithm: digest}."""
+    contexts = {}
+    for algorithm in algorithms:
+        generator_options = dict(options or {})
+        generator_options['algorithm'] = algorithm
+        contexts[algorithm] = hash_generator().option(generator_options).new()
+
+    if hasattr(data_or_stream, 'read'):
+        chunks = iter(lambda: data_or_stream.read(FILE_CHUNK_SIZE), '')
+    else:
+        chunks = (
+            data_or_stream[i:i + FILE_CHUNK_SIZE]
+            for i in xrange(0, len(data_or_stream), FILE_CHUNK_SIZE)
+        )
+    for chunk in chunks:
+        for context in contexts.itervalues():
+            context.update(chunk)
+    return dict(
+        (algorithm, contexts[algorithm].result()) for algorithm in contexts
+    )
+
 class object_hasher:
-    
-    def __init__(self, algorithm):
+    """Hash a structure of str, unicode, bool, int, long, float, None,
+    list, tuple and dict objects.
+
+    Two modes are available:
+
+    'tree' (the default) hashes every scalar and list on its own, and every
+    dict entry as a HMAC keyed with the hash of its key. The sorted entry
+    digests make up the hash of the dict. Identity IDs and OTR packets are
+    hashed this way, so it must stay unchanged. It does not accept unicode,
+    long or None.
+
+    'canonical' writes a type-tagged encoding of the whole object into a
+    single hash context, without recursion. Each value is a tag byte
+    followed by its data:
+
+        's' + length + bytes            str
+        'u' + length + UTF-8 bytes      unicode
+        'i' + length + decimal digits   int, long
+        'f' + 8 bytes IEEE 754 double   float
+        'T' / 'F' / 'N'                 True / False / None
+        'l' + count + items             list or tuple
+        'd' + count + key, value, ...   dict, sorted by encoded key
+
+    where length and count are 8-byte big-endian integers. It needs one
+    hash computation for the whole object, not one per node."""
+
+    MODES = ['tree', 'canonical']
+
+    # Encoded text is passed to the hash context in pieces of this size.
+    CANONICAL_BUFFER = 65536
+
+    def __init__(self, algorithm, mode='tree'):
+        if not mode in self.MODES:
+            raise RuntimeError('Unrecognized object hashing mode.')
+        self.mode = mode
         self.hasher = hash_generator()
         self.hasher.option({
             'algorithm': algorithm,
             'output_format': 'raw',
         })
+        self._keyed_hasher = hash_generator().option({
+            'algorithm': algorithm,
+            'output_format': 'raw',
+        })
 
     def hash(self, obj):
+        if self.mode == 'canonical':
+            return self._hash_canonical(obj)
+        return self._hash_tree(obj)
+
+    def _hash_tree(self, obj):
         typ = type(obj)
         if typ in [str, bool, int, float]:
-            self.hasher.option('HMAC', False)
             return self.hasher.digest(str(typ) + str(obj))
         elif typ in [list, tuple]:
             target = ''.join([
-                self.hash(i) for i in obj
+                self._hash_tree(i) for i in obj
             ])
-            self.hasher.option('HMAC', False)
             return self.hasher.digest(str(typ) + target)
         elif typ == dict:
             result_list = []
             for key in obj:
-                target = self.hash(obj[key])
-                self.hasher.option('HMAC', self.hash(key))
+                target = self._hash_tree(obj[key])
+                self._keyed_hasher.option('HMAC', self._hash_tree(key))
                 result_list.append(
-                    self.hasher.digest(target)
+                    self._keyed_hasher.digest(target)
                 )
             result_list.sort()
-            return self.hash(result_list)
+            return self._hash_tree(result_list)
+        else:
+            raise Exception('Not recognized type of object for hashing.')
+
+    def _hash_canonical(self, obj):
+        context = self.hasher.new()
+        buffered = []
+        buffered_length = 0
+        for piece in _canonical_pieces(obj):
+            buffered.append(piece)
+            buffered_length += len(piece)
+            if buffered_length >= self.CANONICAL_BUFFER:
+                context.update(''.join(buffered))
+                buffered, buffered_length = [], 0
+        context.update(''.join(buffered))
+        return context.digest()
+
+class _merkle_record:
+    """What merkle_hasher remembers of one container."""
+
+    def __init__(self, obj):
+        self.obj = obj          # keeps id(obj) from being reused
+        self.digest = None      # None: to be hashed again
+        self.dirty = set()      # keys or indexes changed; None: all
+        self.parents = set()    # (id(parent container), key) referencing it
+        # dict: {key: [key digest, entry, value if a container]}
+        # list: [item if a container, else None]
+        self.slots = None
+        # dict: root _merkle_node; list: levels of digests, items first
+        self.tree = None
+
+class _merkle_node:
+    """A node of the key digest trie of a dict: a bucket of keys, or split
+    into 16 children by the next nibble of the key digest."""
+
+    def __init__(self):
+        self.digest = None
+        self.count = 0
+        self.keys = set()
+        self.children = None
+
+def _nibble(key_digest, depth):
+    byte = ord(key_digest[depth >> 1])
+    if depth & 1:
+        return byte & 15
+    return byte >> 4
+
+class merkle_hasher:
+    """Hash structures like object_hasher in 'canonical' mode, but as a
+    Merkle tree whose digests are remembered between calls.
+
+    With H the chosen algorithm and count an 8-byte big-endian integer:
+
+    A scalar is hashed as H(0x00 + canonical encoding).
+
+    A list or tuple: the item digests are combined FANOUT at a time into
+    H(0x02 + digests), level by level, until at most FANOUT are left. The
+    list digest is H(0x01 + 'l' + count + remaining digests).
+
+    A dict: each entry is the key digest, H(0x00 + canonical encoding of
+    the key), followed by the value digest. The entries are placed in a trie
+    by the nibbles of their key digests. A node with at most BUCKET_SIZE
+    entries is a bucket, whose content is its entries in sorted order. A
+    larger node is split by the next nibble; its content is, for every
+    non-empty child in nibble order, the nibble as a byte followed by the
+    child digest. A child digest is H(0x02 + content) for a bucket and
+    H(0x03 + content) for a split node. The dict digest is
+    H(0x01 + 'd' + count + content of the root).
+
+    Small containers therefore hash to H(0x01 + 'l' or 'd' + count + item
+    or sorted entry digests). The structure depends only on the content,
+    not on the order of changes.
+
+    Lists and dicts cannot tell when they are changed, so every change has
+    to be reported with update(root, path, value) or invalidate(root,
+    path), 'path' being the list of keys or indexes leading from root to
+    the changed item. To remove a dict entry, delete it and invalidate its
+    path. The next hash() then only hashes the nodes along that path, about
+    log(n) per container, wherever the changed object is referenced: a
+    container shared by several parents is hashed again in all of them.
+    Changing the length of a list hashes the whole list again, from the
+    remembered digests of its items. Changing an object behind the hasher's
+    back gives stale digests.
+
+    A container is remembered while it is referenced by a remembered
+    container, or was passed to hash() itself. Replaced containers are
+    dropped; forget() drops one passed to hash()."""
+
+    FANOUT = 16
+    BUCKET_SIZE = 16
+
+    def __init__(self, algorithm):
+        if not algorithm in _get_algorithms():
+            raise RuntimeError('Unrecognized hash method.')
+        self._hash = _get_algorithms()[algorithm][1].hash
+        self.clear()
+
+    def hash(self, obj):
+        if not type(obj) in (list, tuple, dict):
+            return self._leaf_digest(obj)
+        cache = self._cache
+        self._roots.add(id(obj))
+        stack = [(obj, False)]
+        active = set()
+        while stack:
+            item, expanded = stack.pop()
+            record = cache.get(id(item))
+            if expanded:
+                active.discard(id(item))
+                self._refresh(item, record)
+                continue
+            if record != None and record.digest != None:
+                continue
+            if id(item) in active:
+                raise Exception('Cannot hash an object containing itself.')
+            active.add(id(item))
+            stack.append((item, True))
+            for key in self._changed_keys(item, record):
+                value = item[key]
+                if type(value) in (list, tuple, dict):
+                    stack.append((value, False))
+        self._release()
+        return cache[id(obj)].digest
+
+    def invalidate(self, root, path):
+        """Forget the digests of root and of all items along path. If the
+        last key of path has been removed from its dict, its entry is
+        dropped."""
+        node = root
+        for key in path:
+            self._mark(node, key)
+            try:
+                node = node[key]
+            except (KeyError, IndexError):
+                return
+        self._mark(node, None)
+
+    def update(self, root, path, value):
+        """Set the item at 'path' below root to value, and invalidate the
+        digests which this changes."""
+        if not path:
+            raise RuntimeError('Cannot update the root itself.')
+        parent = root
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = value
+        self.invalidate(root, path)
+
+    def forget(self, root):
+        """Drop the digests of a structure passed to hash(), unless it is
+        also part of another remembered structure."""
+        self._roots.discard(id(root))
+        record = self._cache.get(id(root))
+        if record != None and record.obj is root and not record.parents:
+            self._evict(root)
+
+    def clear(self):
+        """Forget all cached digests."""
+        # id(container) -> _merkle_record
+        self._cache = {}
+        self._roots = set()
+        # Links to be removed once hash() has added all new ones, so that
+        # an object moved to another place is not dropped on the way.
+        self._unlinks = []
+
+    def _changed_keys(self, item, record):
+        """Return the keys or indexes of item to be hashed again."""
+        if type(item) == dict:
+            if record == None or record.dirty == None:
+                return item.keys()
+            return [key for key in record.dirty if key in item]
+        if record == None or record.dirty == None or \
+                len(record.slots) != len(item):
+            return xrange(len(item))
+        return [index for index in record.dirty if index < len(item)]
+
+    def _mark(self, node, key):
+        """Mark entry 'key' of node (all entries if None) as changed, and
+        the entries referencing node in all its parents, recursively."""
+        pending = [(node, key)]
+        while pending:
+            node, key = pending.pop()
+            record = self._cache.get(id(node))
+            if record == None or record.obj is not node:
+                continue
+            if key == None:
+                record.dirty = None
+            elif record.dirty != None:
+                record.dirty.add(key)
+            # The parents of a container without digest have been marked
+            # already.
+            if record.digest != None:
+                record.digest = None
+                for parent_id, parent_key in record.parents:
+                    pending.append((self._cache[parent_id].obj, parent_key))
+
+    def _leaf_digest(self, item):
+        # Short cuts for the commonest scalars, encoded as by
+        # canonical_encode().
+        if type(item) == str:
+            return self._hash('\x00s' + struct.pack('>Q', len(item)) + item)
+        if type(item) in (int, long) and type(item) != bool:
+            item = str(item)
+            return self._hash('\x00i' + struct.pack('>Q', len(item)) + item)
+        return self._hash('\x00' + canonical_encode(item))
+
+    def _digest_of(self, item):
+        if type(item) in (list, tuple, dict):
+            return self._cache[id(item)].digest
+        return self._leaf_digest(item)
+
+    def _refresh(self, item, record):
+        if record == None:
+            record = self._cache[id(item)] = _merkle_record(item)
+            record.dirty = None
+        if type(item) == dict:
+            content = self._refresh_dict(record)
+            header = 'd'
+        else:
+            content = self._refresh_list(record)
+            header = 'l'
+        record.digest = self._hash(
+            '\x01' + header + struct.pack('>Q', len(item)) + content
+        )
+        record.dirty = set()
+
+    def _relink(self, record, key, old_child, new_child):
+        if old_child is new_child:
+            return
+        if new_child != None:
+            self._cache[id(new_child)].parents.add((id(record.obj), key))
+        if old_child != None:
+            self._unlinks.append((old_child, id(record.obj), key))
+
+    def _release(self):
+        unlinks, self._unlinks = self._unlinks, []
+        for child, parent_id, key in unlinks:
+            record = self._cache.get(id(child))
+            if record == None or record.obj is not child:
+                continue
+            record.parents.discard((parent_id, key))
+            if not record.parents and not id(child) in self._roots:
+                self._evict(child)
+
+    def _evict(self, obj):
+        """Drop obj and all its descendants not referenced elsewhere."""
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            record = self._cache.pop(id(obj), None)
+            if record == None:
+                continue
+            if type(obj) == dict:
+                children = [
+                    (key, slot[2]) for key, slot in record.slots.iteritems()
+                ]
+            else:
+                children = enumerate(record.slots)
+            for key, child in children:
+                child_record = self._cache.get(id(child))
+                if child == None or child_record == None:
+                    continue
+                child_record.parents.discard((id(obj), key))
+                if not child_record.parents and \
+                        not id(child) in self._roots:
+                    stack.append(child)
+
+    def _refresh_list(self, record):
+        item = record.obj
+        fanout = self.FANOUT
+        digest_of = self._digest_of
+        if record.dirty == None or len(record.slots) != len(item):
+            old_slots = record.slots or []
+            slots = []
+            for index in xrange(len(item)):
+                value = item[index]
+                if not type(value) in (list, tuple, dict):
+                    value = None
+                slots.append(value)
+            for index in xrange(max(len(old_slots), len(slots))):
+                self._relink(
+                    record,
+                    index,
+                    index < len(old_slots) and old_slots[index] or None,
+                    index < len(slots) and slots[index] or None,
+                )
+            record.slots = slots
+            levels = [[digest_of(value) for value in item]]
+            while len(levels[-1]) > fanout:
+                below = levels[-1]
+                levels.append([
+                    self._hash('\x02' + ''.join(below[i:i + fanout]))
+                    for i in xrange(0, len(below), fanout)
+                ])
+            record.tree = levels
+        else:
+            levels = record.tree
+            for index in record.dirty:
+                value = item[index]
+                child = None
+                if type(value) in (list, tuple, dict):
+                    child = value
+                self._relink(record, index, record.slots[index], child)
+                record.slots[index] = child
+                levels[0][index] = digest_of(value)
+            groups = record.dirty
+            for level in xrange(1, len(levels)):
+                groups = set(index // fanout for index in groups)
+                below = levels[level - 1]
+                for group in groups:
+                    levels[level][group] = self._hash('\x02' + ''.join(
+                        below[group * fanout:(group + 1) * fanout]
+                    ))
+        return ''.join(record.tree[-1])
+
+    def _refresh_dict(self, record):
+        item = record.obj
+        if record.dirty == None:
+            old_slots = record.slots or {}
+            slots = record.slots = {}
+            leaf_digest = self._leaf_digest
+            for key, value in item.iteritems():
+                old_slot = old_slots.get(key)
+                if old_slot != None:
+                    key_digest, old_child = old_slot[0], old_slot[2]
+                else:
+                    key_digest, old_child = leaf_digest(key), None
+                if type(value) in (list, tuple, dict):
+                    child = value
+                    value_digest = self._cache[id(value)].digest
+                else:
+                    child = None
+                    value_digest = leaf_digest(value)
+                slots[key] = [key_digest, key_digest + value_digest, child]
+                self._relink(record, key, old_child, child)
+            for key in old_slots:
+                if not key in slots:
+                    self._relink(record, key, old_slots[key][2], None)
+            record.tree = _merkle_node()
+            record.tree.keys = set(slots)
+            record.tree.count = len(slots)
+            self._trie_split(record.tree, 0, slots)
+        else:
+            for key in record.dirty:
+                old_slot = record.slots.get(key)
+                if key in item:
+                    slot = self._dict_slot(key, item[key], old_slot)
+                    record.slots[key] = slot
+                    self._trie_set(record, key, old_slot == None)
+                    self._relink(record, key, old_slot and old_slot[2], slot[2])
+                elif old_slot != None:
+                    self._trie_remove(record, key)
+                    del record.slots[key]
+                    self._relink(record, key, old_slot[2], None)
+        return self._trie_content(record.tree, record.slots)
+
+    def _dict_slot(self, key, value, old_slot):
+        if old_slot != None:
+            key_digest = old_slot[0]
+        else:
+            key_digest = self._leaf_digest(key)
+        child = None
+        if type(value) in (list, tuple, dict):
+            child = value
+        return [key_digest, key_digest + self._digest_of(value), child]
+
+    def _trie_split(self, node, depth, slots):
+        """Split node, holding its keys, as far as it is too large."""
+        if node.count <= self.BUCKET_SIZE:
+            return
+        pending = [(node, depth)]
+        while pending:
+            node, depth = pending.pop()
+            if node.count <= self.BUCKET_SIZE or \
+                    depth >= 2 * len(slots[iter(node.keys).next()][0]):
+                continue
+            node.children = [None] * 16
+            for key in node.keys:
+                nibble = _nibble(slots[key][0], depth)
+                child = node.children[nibble]
+                if child == None:
+                    child = node.children[nibble] = _merkle_node()
+                child.keys.add(key)
+                child.count += 1
+            node.keys = None
+            for child in node.children:
+                if child != None:
+                    pending.append((child, depth + 1))
+
+    def _trie_set(self, record, key, is_new):
+        key_digest = record.slots[key][0]
+        node, depth = record.tree, 0
+        while True:
+            node.digest = None
+            if is_new:
+                node.count += 1
+            if node.keys != None:
+                break
+            nibble = _nibble(key_digest, depth)
+            if node.children[nibble] == None:
+                node.children[nibble] = _merkle_node()
+            node, depth = node.children[nibble], depth + 1
+        node.keys.add(key)
+        self._trie_split(node, depth, record.slots)
+
+    def _trie_remove(self, record, key):
+        key_digest = record.slots[key][0]
+        node, depth = record.tree, 0
+        path = []
+        while True:
+            node.digest = None
+            node.count -= 1
+            path.append(node)
+            if node.keys != None:
+                break
+            node, depth = node.children[_nibble(key_digest, depth)], depth + 1
+        node.keys.discard(key)
+        # The highest split node which is small enough now becomes a bucket.
+        for node in path:
+            if node.keys == None and node.count <= self.BUCKET_SIZE:
+                keys = set()
+                pending = [node]
+                while pending:
+                    below = pending.pop()
+                    if below.keys != None:
+                        keys.update(below.keys)
+                    else:
+                        pending.extend(i for i in below.children if i != None)
+                node.keys, node.children = keys, None
+                break
+
+    def _trie_content(self, node, slots):
+        if node.keys != None:
+            return ''.join(sorted(slots[key][1] for key in node.keys))
+        pieces = []
+        for nibble in xrange(16):
+            child = node.children[nibble]
+            if child == None or not child.count:
+                continue
+            if child.digest == None:
+                tag = child.keys != None and '\x02' or '\x03'
+                child.digest = self._hash(tag + self._trie_content(child, slots))
+            pieces.append(chr(nibble) + child.digest)
+        return ''.join(pieces)
+
+def canonical_encode(obj):
+    """Return the canonical encoding of obj, as hashed by object_hasher in
+    'canonical' mode."""
+    return ''.join(_canonical_pieces(obj))
+
+def _canonical_pieces(obj):
+    """Generate the canonical encoding of obj piece by piece. An explicit
+    stack replaces recursion, so the nesting depth is not limited."""
+    pack_length = struct.Struct('>Q').pack
+    pack_float = struct.Struct('>d').pack
+    # Stack of objects still to be encoded. _ENCODED marks the next item
+    # as a ready-made piece, _LEAVE the end of a container.
+    stack = [obj]
+    active = set()
+    while stack:
+        item = stack.pop()
+        if item is _ENCODED:
+            yield stack.pop()
+            continue
+        if item is _LEAVE:
+            active.discard(stack.pop())
+            continue
+        typ = type(item)
+        if typ == str:
+            yield 's' + pack_length(len(item))
+            yield item
+        elif typ == unicode:
+            item = item.encode('utf-8')
+            yield 'u' + pack_length(len(item))
+            yield item
+        elif typ == bool:
+            yield item and 'T' or 'F'
+        elif typ in (int, long):
+            item = str(item)
+            yield 'i' + pack_length(len(item)) + item
+        elif typ == float:
+            yield 'f' + pack_float(item)
+        elif item is None:
+            yield 'N'
+        elif typ in (list, tuple, dict):
+            if id(item) in active:
+                raise Exception('Cannot hash an object containing itself.')
+            active.add(id(item))
+            stack.extend([id(item), _LEAVE])
+            if typ == dict:
+                yield 'd' + pack_length(len(item))
+                entries = sorted(
+                    (canonical_encode(key), item[key]) for key in item
+                )
+                for encoded_key, value in reversed(entries):
+                    stack.extend([value, encoded_key, _ENCODED])
+            else:
+                yield 'l' + pack_length(len(item))
+                stack.extend(reversed(item))
         else:
             raise Exception('Not recognized type of object for hashing.')
-            
 
+_ENCODED = object()
+_LEAVE = object()
+
+
+def _merkle_selftest():
+    # Random changes to a structure with large and shared containers; the
+    # incremental digest must always equal that of a fresh hasher.
+    import random
+    generator = random.Random(1)
+    shared = {'shared': range(40)}
+    root = {
+        'table': dict(('key %d' % i, i) for i in xrange(500)),
+        'list': [[i, str(i)] for i in xrange(300)],
+        'a': [shared, shared],
+        'b': (shared, 'b'),
+    }
+    hasher = merkle_hasher('SHA-1')
+    hasher.hash(root)
+    for step in xrange(300):
+        choice = generator.randrange(6)
+        if choice == 0:
+            key = 'key %d' % generator.randrange(700)
+            hasher.update(root, ['table', key], generator.random())
+        elif choice == 1 and root['table']:
+            key = generator.choice(root['table'].keys())
+            del root['table'][key]
+            hasher.invalidate(root, ['table', key])
+        elif choice == 2:
+            index = generator.randrange(len(root['list']))
+            if type(root['list'][index]) == list:
+                hasher.update(root, ['list', index, 0], str(step))
+        elif choice == 3:
+            root['list'].append([step])
+            hasher.invalidate(root, ['list'])
+        elif choice == 4:
+            index = generator.randrange(40)
+            hasher.update(root, ['a', 0, 'shared', index], step)
+        else:
+            index = generator.randrange(len(root['list']))
+            hasher.update(root, ['list', index], {'new': [step]})
+        assert hasher.hash(root) == merkle_hasher('SHA-1').hash(root)
+
+    # Replaced containers are dropped.
+    containers = set()
+    pending = [root]
+    while pending:
+        item = pending.pop()
+        if type(item) in (list, tuple, dict):
+            containers.add(id(item))
+            if type(item) == dict:
+                pending.extend(item.values())
+            else:
+                pending.extend(item)
+    assert set(hasher._cache) == containers
+    hasher.forget(root)
+    assert not hasher._cache
+
+# Tree hashing: default leaf size, and how many leaves make up one task of
+# the process pool. Inputs with fewer than TREE_PARALLEL_MIN_LEAVES leaves
+# are hashed in the calling process.
+TREE_LEAF_SIZE = 1024 * 1024
+TREE_TASK_LEAVES = 4
+TREE_PARALLEL_MIN_LEAVES = 8
+
+def _tree_leaf_task(task):
+    algorithm, source, offset, count, leaf_size = task
+    hash_class = _get_algorithms()[algorithm][1]
+    if type(source) == str:
+        data = source
+    else:
+        # A file: only the leaves of this task are read.
+        f = open(source[0], 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(count * leaf_size)
+        finally:
+            f.close()
+        offset = 0
+    return [
+        hash_class.hash(chr(0) + data[i:i + leaf_size])
+        for i in xrange(offset, offset + count * leaf_size, leaf_size)
+    ]
+
+class tree_hasher:
+    """Hash a large text or file as a Merkle tree, spreading the work over
+    a process pool.
+
+    The input is cut into leaves of 'leaf_size' bytes, the last one may be
+    shorter. An empty input has a single, empty leaf. With H the chosen
+    algorithm:
+
+        leaf digest = H(0x00 + leaf)
+        node digest = H(0x01 + left child digest + right child digest)
+
+    Leaf digests are paired from left to right into nodes, level by level.
+    A digest left over at the end of a level is moved up unchanged. The
+    digest of the single remaining node is the root.
+
+    A tree digest depends on the leaf size and is not the same as the flat
+    digest of the input; both must be stored together. Keeping the leaf
+    digests allows checking parts of a file later, see verify_file()."""
+
+    def __init__(self, algorithm, leaf_size=TREE_LEAF_SIZE, processes=None):
+        if not algorithm in _get_algorithms():
+            raise RuntimeError('Unrecognized hash method.')
+        if leaf_size < 1:
+            raise RuntimeError('Invalid leaf size.')
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.processes = processes
+        self._hash_class = _get_algorithms()[algorithm][1]
+
+    def digest(self, text):
+        """Return the raw root digest of text."""
+        return self.root(self.leaf_digests(text))
+
+    def digest_file(self, path):
+        """Return the raw root digest of the file at 'path'."""
+        return self.root(self.file_leaf_digests(path))
+
+    def leaf_digests(self, text):
+        """Return the list of leaf digests of text."""
+        count = max(1, -(-len(text) // self.leaf_size))
+        step = TREE_TASK_LEAVES * self.leaf_size
+        return self._run([
+            (
+                self.algorithm,
+                text[offset:offset + step],
+                0,
+                min(TREE_TASK_LEAVES, count - offset // self.leaf_size),
+                self.leaf_size,
+            )
+            for offset in xrange(0, count * self.leaf_size, step)
+        ])
+
+    def file_leaf_digests(self, path, indexes=None):
+        """Return the list of leaf digests of the file at 'path'. With
+        'indexes', only these leaves are hashed and the digests are
+        returned in the same order; indexes beyond the file are skipped."""
+        count = max(1, -(-os.path.getsize(path) // self.leaf_size))
+        if indexes == None:
+            ranges = [
+                (first, min(TREE_TASK_LEAVES, count - first))
+                for first in xrange(0, count, TREE_TASK_LEAVES)
+            ]
+        else:
+            ranges = [(i, 1) for i in indexes if 0 <= i < count]
+        return self._run([
+            (
+                self.algorithm,
+                (path,),
+                first * self.leaf_size,
+                leaves,
+                self.leaf_size,
+            )
+            for first, leaves in ranges
+        ])
+
+    def root(self, leaf_digests):
+        """Combine a list of leaf digests into the raw root digest."""
+        level = list(leaf_digests)
+        if not level:
+            raise RuntimeError('No leaf digests given.')
+        node = chr(1)
+        while len(level) > 1:
+            parents = [
+                self._hash_class.hash(node + level[i] + level[i + 1])
+                for i in xrange(0, len(level) - 1, 2)
+            ]
+            if len(level) % 2:
+                parents.append(level[-1])
+            level = parents
+        return level[0]
+
+    def verify_file(self, path, leaf_digests, indexes=None):
+        """Compare the file at 'path' with stored leaf digests. With
+        'indexes', only these leaves are checked. Returns the sorted list
+        of indexes of the leaves that differ, including leaves missing in
+        the file or in 'leaf_digests'."""
+        count = max(1, -(-os.path.getsize(path) // self.leaf_size))
+        if indexes == None:
+            indexes = xrange(max(count, len(leaf_digests)))
+        indexes = sorted(set(indexes))
+        checked = [i for i in indexes if i < count and i < len(leaf_digests)]
+        digests = self.file_leaf_digests(path, checked)
+        bad = set(i for i in indexes if i >= count or i >= len(leaf_digests))
+        for index, digest in zip(checked, digests):
+            if digest != leaf_digests[index]:
+                bad.add(index)
+        return sorted(bad)
+
+    def _run(self, tasks):
+        # Imported here: every database access loads this module, only tree
+        # hashing needs a pool.
+        import multiprocessing
+        processes = self.processes
+        if processes == None:
+            processes = multiprocessing.cpu_count()
+        leaves = sum(task[3] for task in tasks)
+        if leaves < TREE_PARALLEL_MIN_LEAVES or processes < 2 or \
+                len(tasks) < 2:
+            outputs = map(_tree_leaf_task, tasks)
+        else:
+            pool = multiprocessing.Pool(min(processes, len(tasks)))
+            try:
+                outputs = pool.map(_tree_leaf_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return [digest for output in outputs for digest in output]
+
+# Stream mode: the largest request accepted, and how many hash generators
+# with different options are kept for reuse.
+STREAM_MAX_REQUEST = 64 * 1024 * 1024
+STREAM_GENERATORS = 16
+
+def serve_stream(instream, outstream):
+    """Serve length-prefixed hash requests from instream until its end,
+    writing the responses to outstream. See 'Stream Mode' above."""
+    import msgpack
+
+    length_prefix = struct.Struct('>I')
+    generators = collections.OrderedDict()
+
+    def respond(response):
+        response = msgpack.packb(response)
+        outstream.write(length_prefix.pack(len(response)) + response)
+        outstream.flush()
+
+    while True:
+        header = instream.read(length_prefix.size)
+        if not header:
+            break
+        if len(header) < length_prefix.size:
+            respond({'error': 'Truncated request.'})
+            break
+        length = length_prefix.unpack(header)[0]
+        if length > STREAM_MAX_REQUEST:
+            # The rest of the stream cannot be trusted any more.
+            respond({'error': 'Request too large.'})
+            break
+        request = instream.read(length)
+        if len(request) < length:
+            respond({'error': 'Truncated request.'})
+            break
+
+        try:
+            arguments = msgpack.unpackb(request)
+            options = arguments['options']
+
+            # Generators are reused, so that the HMAC states of a key are
+            # computed once for a whole batch.
+            options_id = tuple(sorted(options.items()))
+            hasher = generators.pop(options_id, None)
+            if hasher == None:
+                hasher = hash_generator().option(options)
+            generators[options_id] = hasher
+            if len(generators) > STREAM_GENERATORS:
+                generators.popitem(last=False)
+
+            if 'algorithms' in arguments:
+                if 'file' in arguments:
+                    source = open(arguments['file'], 'rb')
+                    try:
+                        digests = multi_digest(
+                            source, arguments['algorithms'], options
+                        )
+                    finally:
+                        source.close()
+                else:
+                    digests = multi_digest(
+                        arguments['text'], arguments['algorithms'], options
+                    )
+                respond({'digests': digests})
+            elif 'file' in arguments:
+                respond({'digest': hasher.digest_file(arguments['file'])})
+            else:
+                respond({'digest': hasher.digest(arguments['text'])})
+        except KeyError:
+            respond({'error': 'Request without correct arguments.'})
+        except Exception,e:
+            respond({'error': str(e) or 'Invalid request.'})
 
 if __name__ == '__main__':
 
@@ -181,6 +1188,14 @@ if __name__ == '__main__':
     
     import msgpack
 
+    if sys.argv[1:] == ['stream']:
+        serve_stream(sys.stdin, sys.stdout)
+        sys.exit()
+
+    if sys.argv[1:] == ['selftest']:
+        _merkle_selftest()
+        sys.exit()
+
     hasher = hash_generator()
 
     try:
@@ -188,7 +1203,8 @@ if __name__ == '__main__':
         arguments = msgpack.unpackb(cmd_argv.decode('hex'))
 
         options = arguments['options']
-        text = arguments['text']
+        if not 'file' in arguments:
+            text = arguments['text']
 
         hasher.option(options)
     except TypeError:
@@ -196,4 +1212,44 @@ if __name__ == '__main__':
     except KeyError:
         raise RuntimeError('Hash program called without correct arguments.')
 
-    print hasher.digest(text)
+    if 'algorithms' in arguments:
+        import json
+        if 'file' in arguments:
+            source = open(arguments['file'], 'rb')
+            try:
+                digests = multi_digest(
+                    source, arguments['algorithms'], options
+                )
+            finally:
+                source.close()
+        else:
+            digests = multi_digest(text, arguments['algorithms'], options)
+        print json.dumps(digests, sort_keys=True)
+    elif arguments.get('tree'):
+        leaf_size = arguments['tree']
+        if type(leaf_size) == bool:
+            leaf_size = TREE_LEAF_SIZE
+        try:
+            leaf_size = int(leaf_size)
+        except (TypeError, ValueError):
+            raise RuntimeError(
+                'Hash program called without correct arguments.'
+            )
+        if hasher.option('HMAC') != False:
+            raise RuntimeError('HMAC is not available for tree hashing.')
+        tree = tree_hasher(hasher.option('algorithm'), leaf_size)
+        if 'file' in arguments:
+            root = tree.digest_file(arguments['file'])
+        else:
+            root = tree.digest(text)
+        print _format_output(root, hasher.option('output_format'))
+    elif 'file' in arguments:
+        stats = {}
+        print hasher.digest_file(arguments['file'], stats)
+        sys.stderr.write('%d bytes in %.3f seconds, %.0f bytes/sec\n' % (
+            stats['bytes'],
+            stats['seconds'],
+            stats['bytes'] / max(stats['seconds'], 1e-6),
+        ))
+    else:
+        print hasher.digest(text)
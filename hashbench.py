@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hash Benchmark
+==============
+
+Description
+-----------
+Times every algorithm registered in cryptoalgo.hash, at each input size in
+SIZES, in these modes:
+
+    'hash'              hash_generator.digest() of a text
+    'hmac'              the same, with option 'HMAC' set
+    'object-tree'       object_hasher in 'tree' mode, as used for identity
+                        IDs and OTR, on a list of 64-byte strings of the
+                        same total size
+    'object-canonical'  the same in 'canonical' mode
+
+These use the backend each algorithm module has chosen ('active'). The pure
+Python engines are also timed in modes 'hash' and 'hmac' as backend 'pure',
+so both can be compared on the same device. Each measurement repeats the
+operation until MIN_TIME seconds have passed, and the best of REPEAT
+measurements is kept.
+Sizes above PURE_MAX_SIZE are skipped for the pure engines, which are too
+slow for them.
+
+The results are printed as a table. They can be written to a JSON file:
+
+    {'python': ..., 'platform': ..., 'results': [
+        {'algorithm': ..., 'backend': ..., 'mode': ..., 'size': ...,
+         'bytes_per_second': ...}, ...]}
+
+and compared later with another run: measurements slower than the earlier
+ones by more than REGRESSION_TOLERANCE are reported as regressions.
+
+SYNPOSIS
+--------
+python hashbench.py <USER-IDENTIFIER> <DATABASE-ACCESS-KEY> <OPERAND> [ARGUMENTS]
+
+<OPERAND> may be 'run' or 'compare'. For 'run', the optional [ARGUMENTS] is
+the HEX-encoded path of a JSON file to write the results to. For 'compare',
+[ARGUMENTS] is the HEX-encoded path of the JSON file of an earlier run.
+
+The database is not used, the first two arguments are accepted only to fit
+the interface of 'invoke'.
+"""
+import platform
+import sys
+import time
+
+from hash import hash_generator, object_hasher, _get_algorithms
+
+SIZES = [64, 1024, 16384, 262144]
+MODES = ['hash', 'hmac', 'object-tree', 'object-canonical']
+PURE_MODES = ['hash', 'hmac']
+
+MIN_TIME = 0.1
+REPEAT = 3
+PURE_MAX_SIZE = 16384
+
+# A slowdown by more than this fraction counts as a regression.
+REGRESSION_TOLERANCE = 0.2
+
+HMAC_KEY = 'hash benchmark key'
+
+def _pure_engines():
+    """Return {algorithm: constructor} of the pure Python engines."""
+    from cryptoalgo.hash import md5, whirlpool, _slowsha
+    return {
+        'MD5': md5.md5,
+        'SHA-1': _slowsha.sha1,
+        'SHA-256': _slowsha.sha256,
+        'SHA-512': _slowsha.sha512,
+        'WHIRLPOOL': whirlpool.Whirlpool,
+    }
+
+def _measure(function, size):
+    """Return the best throughput of function() on 'size' bytes, in bytes
+    per second."""
+    speeds = []
+    for i in xrange(REPEAT):
+        count = 0
+        start = time.time()
+        elapsed = 0
+        while elapsed < MIN_TIME:
+            function()
+            count += 1
+            elapsed = time.time() - start
+        speeds.append(size * count / max(elapsed, 1e-9))
+    return max(speeds)
+
+def _operation(algorithm, mode, size):
+    text = 'x' * size
+    if mode.startswith('object-'):
+        hasher = object_hasher(algorithm, mode[len('object-'):])
+        obj = [text[i:i + 64] for i in xrange(0, size, 64)]
+        return lambda: hasher.hash(obj)
+    generator = hash_generator().option('algorithm', algorithm)
+    if mode == 'hmac':
+        generator.option('HMAC', HMAC_KEY)
+    return lambda: generator.digest(text)
+
+def _pure_operation(algorithm, engine, mode, size):
+    text = 'x' * size
+    if mode == 'hash':
+        return lambda: engine(text).digest()
+    # HMAC as done by hash_generator: the padded key is compressed once,
+    # every message starts from copies of these states.
+    block_size = _get_algorithms()[algorithm][0] / 8
+    key = HMAC_KEY + chr(0) * (block_size - len(HMAC_KEY))
+    inner = engine(''.join(chr(ord(i) ^ 0x36) for i in key))
+    outer = engine(''.join(chr(ord(i) ^ 0x5C) for i in key))
+    def hmac():
+        context = inner.copy()
+        context.update(text)
+        result = outer.copy()
+        result.update(context.digest())
+        return result.digest()
+    return hmac
+
+def run(sizes=None, algorithms=None):
+    """Run the benchmark and return the list of result dicts."""
+    sizes = sizes or SIZES
+    algorithms = algorithms or sorted(_get_algorithms())
+    engines = _pure_engines()
+    results = []
+
+    def record(algorithm, backend, mode, size, speed):
+        results.append({
+            'algorithm': algorithm,
+            'backend': backend,
+            'mode': mode,
+            'size': size,
+            'bytes_per_second': speed,
+        })
+
+    for algorithm in algorithms:
+        for size in sizes:
+            for mode in MODES:
+                record(algorithm, 'active', mode, size,
+                       _measure(_operation(algorithm, mode, size), size))
+            if algorithm in engines and size <= PURE_MAX_SIZE:
+                for mode in PURE_MODES:
+                    operation = _pure_operation(
+                        algorithm, engines[algorithm], mode, size
+                    )
+                    record(algorithm, 'pure', mode, size,
+                           _measure(operation, size))
+    return results
+
+def _result_id(result):
+    return (result['algorithm'], result['backend'], result['mode'],
+            result['size'])
+
+def compare(old_results, new_results):
+    """Compare two lists of results. Returns a list of (result id, old
+    speed, new speed, ratio) for the measurements found in both, and the
+    list of those among them which regressed."""
+    old = dict((_result_id(i), i['bytes_per_second']) for i in old_results)
+    rows, regressions = [], []
+    for result in new_results:
+        result_id = _result_id(result)
+        if not result_id in old:
+            continue
+        new_speed = result['bytes_per_second']
+        ratio = new_speed / old[result_id]
+        row = (result_id, old[result_id], new_speed, ratio)
+        rows.append(row)
+        if ratio < 1 - REGRESSION_TOLERANCE:
+            regressions.append(row)
+    return rows, regressions
+
+def _speed_text(speed):
+    for unit in ['', 'k', 'M', 'G']:
+        if speed < 1000:
+            break
+        speed /= 1000.0
+    return '%.1f %sB/s' % (speed, unit)
+
+def format_table(results):
+    lines = ['%-10s %-7s %-16s %8s %14s' % (
+        'algorithm', 'backend', 'mode', 'size', 'speed'
+    )]
+    for result in results:
+        lines.append('%-10s %-7s %-16s %8d %14s' % (
+            _result_id(result) + (_speed_text(result['bytes_per_second']),)
+        ))
+    return '\n'.join(lines)
+
+def format_comparison(rows):
+    lines = ['%-10s %-7s %-16s %8s %14s %14s %7s' % (
+        'algorithm', 'backend', 'mode', 'size', 'before', 'after', 'ratio'
+    )]
+    for result_id, old_speed, new_speed, ratio in rows:
+        lines.append('%-10s %-7s %-16s %8d %14s %14s %7.2f' % (
+            result_id + (
+                _speed_text(old_speed),
+                _speed_text(new_speed),
+                ratio,
+            )
+        ))
+    return '\n'.join(lines)
+
+def report(results):
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+if __name__ == '__main__':
+    import json
+
+    from _geheimnis_ import output_formator
+
+    output = output_formator()
+
+    try:
+        operand = sys.argv[3]
+        argument = ''
+        if len(sys.argv) > 4:
+            argument = ' '.join(sys.argv[4:]).decode('hex')
+    except Exception,e:
+        output.error("Usage: python hashbench.py " +\
+            "<USER_IDENTIFIER> <DB_ACCESS_KEY> <OPERAND> [ARGUMENTS]")
+        exit()
+
+    operand = operand.strip().lower()
+
+    if operand == 'run':
+        results = run()
+        if argument:
+            try:
+                f = open(argument, 'w')
+                json.dump(report(results), f, indent=1, sort_keys=True)
+                f.close()
+            except IOError,e:
+                output.error('Cannot write results: %s' % e, 500)
+                exit()
+        output.result(format_table(results), 200)
+
+    elif operand == 'compare':
+        try:
+            f = open(argument, 'r')
+            old_results = json.load(f)['results']
+            f.close()
+        except Exception,e:
+            output.error('Cannot read earlier results: %s' % e, 400)
+            exit()
+        rows, regressions = compare(old_results, run())
+        if regressions:
+            output.error(format_comparison(regressions), 409)
+        else:
+            output.result(format_comparison(rows), 200)
+
+    else:
+        output.error('Unrecognized operand.', 405)
+        exit()
@@ -41,9 +41,15 @@ CONFIG_COMMANDS = {
         'identity-delete': {'domain': 'identity', 'operand': 'delete', 'arg': True},
         'identity-add': {'domain': 'identity', 'operand': 'add', 'arg': True},
         'test-instant': {'domain': 'test', 'operand': 'testOperand', 'arg': False},
+        'pki-keypair-find': {'domain': 'pki', 'operand': 'keypair-find', 'arg': True},
+        'pki-pool-status': {'domain': 'pki', 'operand': 'pool-status', 'arg': False},
     },
     'wait': {
         'test-wait': {'domain': 'test', 'operand': 'testOperand', 'arg': False},
+        'selftest': {'domain': 'selftest', 'operand': 'run', 'arg': False},
+        'pki-pool-refill': {'domain': 'pki', 'operand': 'pool-refill', 'arg': False},
+        'hashbench-run': {'domain': 'hashbench', 'operand': 'run', 'arg': False},
+        'hashbench-compare': {'domain': 'hashbench', 'operand': 'compare', 'arg': True},
     },
 }
 
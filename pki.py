@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Public Key Infrastructure
+=========================
+
+Description
+-----------
+This program manages the public key material of a user, stored in the 'pki'
+tables of the database.
+
+Keypairs
+--------
+Keypairs are stored per identity like codebooks, under 'pki/keypairs/<ID>',
+with ID-FINGERPRINT as keypair ID. Private keys are encrypted with the
+database key. Table 'pki/fingerprints' indexes fingerprint -> keypair ID and
+is kept up to date by `keypair_manager`, so a key can be found from the
+fingerprint carried by a signature without scanning the whole store.
+
+Key Pool
+--------
+Generating an RSA keypair of 2048 bits or more takes several seconds on slow
+devices. To avoid letting the user wait, a small pool of fresh keypairs is
+kept for each size in POOL_SIZES, under 'pki/pool/<BITS>'. The private keys
+in the pool are encrypted with the database key. `keypool_manager.generate`
+hands out a pooled keypair, and only generates one on the spot if the pool
+is empty. After `keypool_manager.install`, RSA.Implementation.generate does
+the same, so any code generating keys in this process uses the pool.
+
+The pool is filled up by the operand 'pool-refill', which is meant to be
+run in background by 'invoke' (command 'pki-pool-refill') when the device
+is idle.
+
+SYNPOSIS
+--------
+python pki.py <USER-IDENTIFIER> <DATABASE-ACCESS-KEY> <OPERAND> [ARGUMENTS]
+
+<OPERAND> may be 'keypair-find', 'pool-refill' or 'pool-status'. For
+'keypair-find', [ARGUMENTS] is the HEX-encoded fingerprint. For 'pool-refill',
+the optional [ARGUMENTS] is a HEX-encoded key size in bits, to refill only one
+pool.
+
+`python pki.py selftest` checks the fingerprint index on an in-memory
+database.
+"""
+from cryptoalgo.asymmetric import RSA
+
+class keypair_manager:
+
+    _database = None
+
+    INDEX_PATH = 'pki/fingerprints'
+
+    def __init__(self, database):
+        """Initialize Keypair Manager."""
+        self._database = database
+
+    def add(self, identity, key, description=''):
+        """Add a keypair or a public key.
+
+        'identity' is an instance of identity, 'key' an instance of
+        RSA.Implementation. Returns the new keypair ID."""
+        user_id = identity.get_id()
+        fingerprint = key.get_fingerprint()
+        if self.find(fingerprint) != None:
+            raise Exception('Keypair exists.')
+
+        private_key = None
+        if key.has_private_key():
+            private_key = self._database.encrypt(key.get_private_key())
+
+        keypair_id = (user_id + '-' + fingerprint).upper()
+        insert_piece = {
+            'fingerprint': fingerprint,
+            'public_key': key.get_public_key(),
+            'private_key': private_key,
+            'description': description,
+        }
+        self._database.set('pki/keypairs/%s' % user_id, keypair_id,
+                           insert_piece)
+        self._database.set(self.INDEX_PATH, fingerprint, keypair_id)
+        return keypair_id
+
+    def delete_keypair(self, keypair_id):
+        try:
+            user_id = self._get_user_id(keypair_id)
+            visit_path = 'pki/keypairs/%s' % user_id
+            record = self._database.get(visit_path, keypair_id)
+            self._database.remove(self.INDEX_PATH, record['fingerprint'])
+            self._database.remove(visit_path, keypair_id)
+        except:
+            return False
+        return True
+
+    def delete_user(self, identity):
+        try:
+            user_id = identity.get_id()
+            records = self._database.get('pki/keypairs', user_id) or {}
+            for keypair_id in records:
+                self._database.remove(
+                    self.INDEX_PATH,
+                    records[keypair_id]['fingerprint']
+                )
+            self._database.remove('pki/keypairs', user_id)
+        except:
+            return False
+        return True
+
+    def query(self, identity):
+        """List the keypairs of an identity. Returns False if there are
+        none."""
+        user_keypairs = self._database.get('pki/keypairs', identity.get_id())
+        if not user_keypairs:
+            return False
+        retval = {}
+        for keypair_id in user_keypairs:
+            record = user_keypairs[keypair_id]
+            retval[keypair_id] = {
+                'fingerprint': record['fingerprint'],
+                'description': record['description'],
+                'private': record['private_key'] != None,
+            }
+        return retval
+
+    def find(self, fingerprint):
+        """Return the ID of the keypair with given fingerprint, or None."""
+        return self._database.get(self.INDEX_PATH, fingerprint.lower())
+
+    def load(self, fingerprint, private=False):
+        """Return the key with given fingerprint as an instance of
+        RSA.Implementation, or None if it is not stored. With 'private'
+        set, the private key is loaded, if there is one."""
+        keypair_id = self.find(fingerprint)
+        if keypair_id == None:
+            return None
+        record = self._database.get(
+            'pki/keypairs/%s' % self._get_user_id(keypair_id),
+            keypair_id
+        )
+        if private and record['private_key'] != None:
+            return RSA.Implementation(
+                load=self._database.decrypt(record['private_key'])
+            )
+        return RSA.Implementation(load=record['public_key'])
+
+    def verify(self, fingerprint, message, signature):
+        """Verify a signature made by the key with given fingerprint. An
+        unknown key fails."""
+        key = self.load(fingerprint)
+        if key == None:
+            return False
+        return key.verify(message, signature)
+
+    def rebuild_index(self):
+        """Build the fingerprint index again from all stored keypairs.
+
+        Fingerprints are computed again from the public keys, so records
+        stored with a fingerprint of a non-canonical export are fixed."""
+        index = self._database.get(self.INDEX_PATH)
+        index.clear()
+        users = self._database.get('pki/keypairs')
+        for user_id in users:
+            for keypair_id in users[user_id]:
+                record = users[user_id][keypair_id]
+                key = RSA.Implementation(load=record['public_key'])
+                record['fingerprint'] = key.get_fingerprint()
+                record['public_key'] = key.get_public_key()
+                index[record['fingerprint']] = keypair_id
+
+    def _get_user_id(self, keypair_id):
+        return keypair_id[:keypair_id.find('-')]
+
+class keypool_manager:
+
+    _database = None
+
+    # Key size in bits -> number of keypairs kept in pool.
+    POOL_SIZES = {
+        2048: 4,
+        4096: 2,
+    }
+
+    def __init__(self, database):
+        """Initialize Keypool Manager."""
+        self._database = database
+
+    def generate(self, bits):
+        """Return a new RSA keypair of given size, as an instance of
+        RSA.Implementation.
+
+        A keypair is taken from the pool when there is one. Otherwise it is
+        generated now, which may take long."""
+        key = self.take(bits)
+        if key == None:
+            key = RSA.Implementation()
+            key.generate(bits=bits, pooled=False)
+        return key
+
+    def install(self):
+        """Let RSA.Implementation.generate take its keys from this pool."""
+        RSA.set_key_pool(self)
+        return self
+
+    def take(self, bits):
+        """Remove a keypair of given size from pool and return it. Returns
+        None if the pool is empty."""
+        if not int(bits) in self.POOL_SIZES:
+            return None
+        visit_path = self._pool_path(bits)
+        pool = self._database.get(visit_path)
+        if not pool:
+            return None
+
+        fingerprint = pool.keys()[0]
+        private_key = self._database.decrypt(pool[fingerprint])
+        self._database.remove(visit_path, fingerprint)
+        return RSA.Implementation(load=private_key)
+
+    def refill(self, bits=None):
+        """Generate keypairs until the pool of given size, or all pools if
+        'bits' is None, are full. Returns the number of keys added.
+
+        Generating takes long, and the database tree held by this process
+        would overwrite all changes made meanwhile (e.g. keys taken from
+        the pool) when written back. So the keys are generated without the
+        database open, and are added to a freshly read pool afterwards."""
+        if bits == None:
+            sizes = sorted(self.POOL_SIZES)
+        elif int(bits) in self.POOL_SIZES:
+            sizes = [int(bits)]
+        else:
+            raise RuntimeError('No key pool for %s bits.' % bits)
+
+        missing = [(bits, self.POOL_SIZES[bits] - self.count(bits))
+                   for bits in sizes]
+        self._database.reload()
+
+        new_keys = []
+        for bits, count in missing:
+            for i in xrange(count):
+                key = RSA.Implementation()
+                key.generate(bits=bits, pooled=False)
+                new_keys.append((
+                    bits,
+                    key.get_fingerprint(),
+                    self._database.encrypt(key.get_private_key()),
+                ))
+        if not new_keys:
+            return 0
+
+        self._database.reload()
+        added = 0
+        for bits, fingerprint, private_key in new_keys:
+            if self.count(bits) < self.POOL_SIZES[bits]:
+                self._database.set(self._pool_path(bits), fingerprint,
+                                   private_key)
+                added += 1
+        self._database.sync()
+        return added
+
+    def count(self, bits):
+        """Return the number of pooled keypairs of given size."""
+        return len(self._database.get(self._pool_path(bits)))
+
+    def status(self):
+        """Return {bits: (pooled, wanted)} for all configured sizes."""
+        return dict(
+            (bits, (self.count(bits), self.POOL_SIZES[bits]))
+            for bits in self.POOL_SIZES
+        )
+
+    def _pool_path(self, bits):
+        return 'pki/pool/%d' % int(bits)
+
+def self_test():
+    import hashlib
+
+    import msgpack
+
+    class memory_database:
+        # The part of the database interface used here, kept in memory.
+        def __init__(self):
+            self.tables = {}
+        def _touch_path(self, table_path):
+            root = self.tables
+            for each in table_path.split('/'):
+                root = root.setdefault(each, {})
+            return root
+        def get(self, table_path, key=None):
+            if key == None:
+                return self._touch_path(table_path)
+            return self._touch_path(table_path).get(key)
+        def set(self, table_path, key, value):
+            self._touch_path(table_path)[key] = value
+        def remove(self, table_path, key):
+            self._touch_path(table_path).pop(key, None)
+        def encrypt(self, plaintext):
+            return plaintext
+        def decrypt(self, ciphertext):
+            return ciphertext
+
+    class test_identity:
+        def get_id(self):
+            return 'TEST'
+
+    database = memory_database()
+    keypairs = keypair_manager(database)
+    key = RSA.Implementation()
+    key.generate(bits=1024)
+
+    # A public key exported with leading zero bytes is found under the
+    # fingerprint of the key.
+    fields = msgpack.unpackb(key.get_public_key())
+    padded = msgpack.packb(['RSA'] + ['\x00' + i for i in fields[1:]])
+    keypair_id = keypairs.add(test_identity(), RSA.Implementation(load=padded))
+    assert keypairs.find(key.get_fingerprint()) == keypair_id
+    try:
+        keypairs.add(test_identity(), RSA.Implementation(load=padded))
+        assert False
+    except AssertionError:
+        raise
+    except Exception:
+        pass
+    assert keypairs.verify(key.get_fingerprint(), 'm', key.sign('m'))
+
+    # A record stored under the fingerprint of the padded export is found
+    # once the index is rebuilt.
+    record = database.get('pki/keypairs/TEST', keypair_id)
+    record['fingerprint'] = hashlib.sha1(padded).hexdigest()
+    record['public_key'] = padded
+    keypairs.rebuild_index()
+    assert record['fingerprint'] == key.get_fingerprint()
+    assert database.get(keypairs.INDEX_PATH) == \
+        {key.get_fingerprint(): keypair_id}
+
+    # Once installed, the pool hands out its keys to RSA.Implementation.
+    pool = keypool_manager(database)
+    pooled_key = pool.generate(2048)
+    database.set(pool._pool_path(2048), pooled_key.get_fingerprint(),
+                 database.encrypt(pooled_key.get_private_key()))
+    pool.install()
+    try:
+        new_key = RSA.Implementation()
+        new_key.generate(bits=2048)
+        assert new_key.get_fingerprint() == pooled_key.get_fingerprint()
+        assert pool.count(2048) == 0
+    finally:
+        RSA.set_key_pool(None)
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] == ['selftest']:
+        self_test()
+        sys.exit()
+
+    import json
+
+    from _geheimnis_ import get_database, output_formator
+
+    output = output_formator()
+
+    try:
+        user_identifier, db_access_key, operand = sys.argv[1:4]
+        argument = ''
+        if len(sys.argv) > 4:
+            argument = ' '.join(sys.argv[4:]).decode('hex')
+    except Exception,e:
+        output.error("Usage: python pki.py " +\
+            "<USER_IDENTIFIER> <DB_ACCESS_KEY> <OPERAND> [ARGUMENTS]")
+        exit()
+
+    try:
+        db_access_key = db_access_key.decode('hex')
+        database = get_database(user_identifier, db_access_key)
+    except Exception,e:
+        output.error('Cannot connect to database. Reason: %s' % e, 401)
+        exit()
+
+    operand = operand.strip().lower()
+    pool = keypool_manager(database)
+
+    if operand == 'keypair-find':
+        keypair_id = keypair_manager(database).find(argument)
+        if keypair_id == None:
+            output.error('No keypair with this fingerprint.', 404)
+        else:
+            output.result(keypair_id, 200)
+
+    elif operand == 'pool-refill':
+        try:
+            generated = pool.refill(argument or None)
+        except Exception,e:
+            output.error('Cannot refill key pool: %s' % e, 400)
+            exit()
+        output.result(generated, 200)
+
+    elif operand == 'pool-status':
+        output.result(json.dumps(pool.status()), 200)
+
+    else:
+        output.error('Unrecognized operand.', 405)
+        exit()
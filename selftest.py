@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Algorithm Self-Test
+===================
+
+Runs the known-answer tests of all algorithms in cryptoalgo again, ignoring
+the results cached by earlier imports, and refreshes the cache. Use this
+after changing or reinstalling the code, or to check a new system.
+
+SYNPOSIS
+--------
+python selftest.py <USER-IDENTIFIER> <DATABASE-ACCESS-KEY> run
+
+The database is not used, the first two arguments are accepted only to fit
+the interface of 'invoke'.
+"""
+
+if __name__ == '__main__':
+    import sys
+    import json
+
+    from _geheimnis_ import output_formator
+    from cryptoalgo import selftest
+
+    output = output_formator()
+
+    try:
+        operand = sys.argv[3]
+    except Exception,e:
+        output.error("Usage: python selftest.py " +\
+            "<USER_IDENTIFIER> <DB_ACCESS_KEY> <OPERAND>")
+        exit()
+
+    operand = operand.strip().lower()
+
+    if operand == 'run':
+        results = selftest.run_all()
+        failed = [name for name, error in results if error is not None]
+        report = json.dumps(dict(results))
+        if failed:
+            output.error(report, 500)
+        else:
+            output.result(report, 200)
+
+    else:
+        output.error('Unrecognized operand.', 405)
+        exit()